@@ -0,0 +1,297 @@
+"""
+benchmark suite of the periodicity detectors on simulated workloads
+
+Every case generates a batch of signals with src/sigsimulation.py and measures
+    - per-signal latency of the method (p50 / p99)
+    - throughput (signals/sec) of the data frame wrap over the whole batch
+    - peak RSS of the process running the case (every case runs in its own process)
+
+The sweep varies one factor at a time around a base case: signal length (1 to 7 days), event density
+(signal period), noise type and level (gauss shift, insertion, omission) and batch size.
+
+Latencies and the wrap run are measured --repeat times and the median run of every signal (and of the wrap)
+is kept, so neither a single noisy pass nor a single lucky one moves the numbers. robustper is only run when named with --methods,
+with the vectorized M-periodogram (mperio='irls', same values as the statsmodels RLM engine).
+
+Usage (from the repository root):
+    python -m benchmarks.bench --output benchmarks/results/run.json
+    python -m benchmarks.bench --quick --methods stats upnsca bcndetection
+    python -m benchmarks.bench --quick --baseline benchmarks/baseline.json --tolerance 0.2
+
+With --baseline, cases that lose more than tolerance of their baseline throughput or whose p99 latency
+grows by more than tolerance are reported as regressions and the exit code is 1. A change is only a
+regression if it also costs more than --abs-floor milliseconds per signal, below that it is timer noise,
+and if it persists over --confirm reruns of the flagged cases (the best run of every case is compared).
+benchmarks/baseline.json is a --quick run of the default methods, regenerate it on the machine that runs the
+comparison with --quick --output benchmarks/baseline.json.
+"""
+import os
+import sys
+import json
+import time
+import resource
+import argparse
+import platform
+import multiprocessing
+from functools import partial
+
+import numpy as np
+
+from src.helpfns import signal_rng
+from src.sigsimulation import gen_signal_df, gen_poisson_signal_df
+from src.statsbased import stats_method, stats_wrap
+from src.upnsca import upnsca_method, upnsca_wrap
+from src.baywatch import baywatch_method, baywatch_wrap
+from src.bcndetection import bcndetection_method, bcndetection_wrap
+from src.robustper import robustper_method, robustper_wrap
+
+
+### method name -> (single signal method, data frame wrap, extra wrap kwargs for batches > 1)
+METHODS = {
+    'stats': (stats_method, stats_wrap, {'batch': True}),
+    'upnsca': (upnsca_method, upnsca_wrap, {'batch': True}),
+    'baywatch': (baywatch_method, baywatch_wrap, {'batch': True}),
+    'bcndetection': (bcndetection_method, bcndetection_wrap, {'batch': True}),
+    'robustper': (partial(robustper_method, mperio='irls'), partial(robustper_wrap, mperio='irls'), {}),
+}
+
+### methods run without --methods, robustper takes minutes per signal on the larger cases
+DEFAULT_METHODS = ['stats', 'upnsca', 'baywatch', 'bcndetection']
+
+### measurements per signal and per wrap run, the median one is kept
+REPEAT = 5
+
+### latency / time per signal changes below this many milliseconds are never regressions
+ABS_FLOOR_MS = 0.5
+
+### reruns of the cases flagged as regressions before they are reported
+CONFIRM = 2
+
+### base case of the one-factor-at-a-time sweep
+BASE_CASE = {'workload': 'gauss', 'level': 0.1, 'days': 1, 'period': 600, 'batch_size': 32}
+
+### values of every swept factor, the other factors stay at BASE_CASE
+SWEEP = {
+    'days': [1, 3, 7],
+    'period': [120, 600, 3600],
+    'workload': [('gauss', 0.0), ('gauss', 0.1), ('gauss', 0.3), ('insert', 0.1), ('insert', 0.3),
+                 ('omit', 0.2), ('omit', 0.5)],
+    'batch_size': [1, 32, 256],
+}
+
+### small sweep for smoke tests
+QUICK_BASE_CASE = dict(BASE_CASE, batch_size=8)
+QUICK_SWEEP = {
+    'days': [1, 3],
+    'workload': [('gauss', 0.1), ('insert', 0.1), ('omit', 0.2)],
+}
+
+
+def sweep_cases(methods, sweep=SWEEP, base=BASE_CASE):
+    """
+    Returns:
+    list: benchmark cases (dicts), one per method and distinct factor combination
+    """
+    combos = []
+    for factor, values in sweep.items():
+        for value in values:
+            case = dict(base)
+            if factor == 'workload':
+                case['workload'], case['level'] = value
+            else:
+                case[factor] = value
+            if case not in combos:
+                combos.append(case)
+    return [dict(case, method=method) for method in methods for case in combos]
+
+
+### identifies a case across runs for the baseline comparison
+def case_key(case):
+    return (case['method'], case['workload'], case['level'], case['days'], case['period'], case['batch_size'])
+
+
+def gen_workload(workload, level, days, period, count, seed=0):
+    """
+    simulated signal frame: gauss shift noise (level = std), poisson insertion noise (level = prate)
+    or omission noise (level = omit rate), period in seconds, one sample per minute
+    """
+    length = 1440 * days
+    if workload == 'gauss':
+        return gen_signal_df(period, std=level, count=count, length=length, seed=seed)
+    if workload == 'omit':
+        return gen_signal_df(period, omit_rate=level, count=count, length=length, seed=seed)
+    if workload == 'insert':
+        return gen_poisson_signal_df(period, prate=level, count=count, length=length, seed=seed)
+    raise ValueError("unknown workload {}".format(workload))
+
+
+### peak resident set size of this process in MB
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2 ** 20 if sys.platform == 'darwin' else rss / 2 ** 10
+
+
+### median of repeat runs of fn() in seconds, and the result of the last run
+def median_time(fn, repeat=REPEAT):
+    elapsed = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = fn()
+        elapsed.append(time.perf_counter() - start)
+    return float(np.median(elapsed)), out
+
+
+def run_case(case, seed=0, repeat=REPEAT):
+    """
+    run one case, meant to be executed in a fresh worker process so peak RSS is per case
+    """
+    method, wrap, batch_kwargs = METHODS[case['method']]
+    df = gen_workload(case['workload'], case['level'], case['days'], case['period'], case['batch_size'], seed)
+    res = dict(case)
+    try:
+        # warm up imports and FFT plans outside of the timed region
+        method(df["tdf"].iloc[0], rng=signal_rng(seed, -1))
+        latencies = [median_time(partial(method, sig, rng=signal_rng(seed, i)), repeat)[0] for i, sig in enumerate(df["tdf"])]
+
+        kwargs = batch_kwargs if case['batch_size'] > 1 else {}
+        elapsed, resdf = median_time(lambda: wrap(df.copy(), seed=seed, **kwargs), repeat)
+
+        res.update({
+            'signals': len(df),
+            'signals_per_sec': len(df) / elapsed,
+            'p50_ms': float(np.percentile(latencies, 50) * 1e3),
+            'p99_ms': float(np.percentile(latencies, 99) * 1e3),
+            'detected_rate': float(np.mean(resdf['detected'])),
+        })
+    except Exception as e:
+        res["error"] = "{}: {}".format(type(e).__name__, str(e).splitlines()[0] if str(e) else "")
+    res['peak_rss_mb'] = peak_rss_mb()
+    return res
+
+
+def run_benchmarks(cases, seed=0, verbose=True, repeat=REPEAT):
+    results = []
+    ctx = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else multiprocessing
+    for case in cases:
+        with ctx.Pool(1, maxtasksperchild=1) as pool:
+            res = pool.apply(run_case, (case, seed, repeat))
+        results.append(res)
+        if verbose:
+            print(format_result(res), flush=True)
+    return results
+
+
+def case_name(case):
+    return "{method:>12} {workload:>6} {level:<4} {days}d period={period:<5} batch={batch_size:<4}".format(**case)
+
+
+def format_result(res):
+    name = case_name(res)
+    if 'error' in res:
+        return "{} ERROR {}".format(name, res['error'])
+    return "{} {:10.1f} sig/s  p50 {:9.2f} ms  p99 {:9.2f} ms  rss {:7.1f} MB".format(
+        name, res['signals_per_sec'], res['p50_ms'], res['p99_ms'], res['peak_rss_mb'])
+
+
+def environment():
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def compare_baseline(results, baseline, tolerance=0.2, abs_floor_ms=ABS_FLOOR_MS):
+    """
+    Parameters:
+        results (list): results of run_benchmarks
+        baseline (dict): stored report with the baseline 'cases'
+        tolerance (float): relative slowdown reported as a regression
+        abs_floor_ms (float): a slowdown must also cost more than this many milliseconds per signal
+    Returns:
+    list: (case, metric, current, baseline) of every regression beyond tolerance
+    """
+    base = {case_key(res): res for res in baseline['cases'] if 'error' not in res}
+    regressions = []
+    for res in results:
+        ref = base.get(case_key(res))
+        if ref is None or 'error' in res:
+            continue
+        cost_ms = 1e3 / res['signals_per_sec'] - 1e3 / ref['signals_per_sec']
+        if res['signals_per_sec'] < (1 - tolerance) * ref['signals_per_sec'] and cost_ms > abs_floor_ms:
+            regressions.append((res, 'signals_per_sec', res['signals_per_sec'], ref['signals_per_sec']))
+        if res['p99_ms'] > (1 + tolerance) * ref['p99_ms'] and res['p99_ms'] - ref['p99_ms'] > abs_floor_ms:
+            regressions.append((res, 'p99_ms', res['p99_ms'], ref['p99_ms']))
+    return regressions
+
+
+### best measurement of a case over two runs: highest throughput and lowest latencies
+def best_of(res, other):
+    if other is None or 'error' in other:
+        return res
+    best = dict(res)
+    best['signals_per_sec'] = max(res['signals_per_sec'], other['signals_per_sec'])
+    for metric in ('p50_ms', 'p99_ms'):
+        best[metric] = min(res[metric], other[metric])
+    return best
+
+
+def confirm_regressions(results, baseline, tolerance=0.2, abs_floor_ms=ABS_FLOOR_MS, confirm=CONFIRM, seed=0, repeat=REPEAT):
+    """
+    compare_baseline, the flagged cases are rerun up to confirm times and only reported if their best run still regresses
+    """
+    regressions = compare_baseline(results, baseline, tolerance, abs_floor_ms)
+    for _ in range(confirm):
+        if not regressions:
+            break
+        flagged = {case_key(res): res for res, _, _, _ in regressions}
+        cases = [{k: res[k] for k in BASE_CASE.keys() | {'method'}} for res in flagged.values()]
+        rerun = {case_key(res): res for res in run_benchmarks(cases, seed, verbose=False, repeat=repeat)}
+        results = [best_of(res, rerun.get(case_key(res))) for res in flagged.values()]
+        regressions = compare_baseline(results, baseline, tolerance, abs_floor_ms)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--methods', nargs='+', default=DEFAULT_METHODS, choices=list(METHODS))
+    parser.add_argument('--quick', action='store_true', help='small sweep for smoke tests')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare against the results in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative slowdown reported as a regression')
+    parser.add_argument('--abs-floor', type=float, default=ABS_FLOOR_MS,
+                        help='milliseconds per signal a slowdown must exceed to be a regression')
+    parser.add_argument('--repeat', type=int, default=REPEAT, help='measurements per signal, the median is kept')
+    parser.add_argument('--confirm', type=int, default=CONFIRM, help='reruns of a case flagged as a regression')
+    args = parser.parse_args(argv)
+
+    if args.quick:
+        cases = sweep_cases(args.methods, QUICK_SWEEP, QUICK_BASE_CASE)
+    else:
+        cases = sweep_cases(args.methods, SWEEP, BASE_CASE)
+    results = run_benchmarks(cases, args.seed, repeat=args.repeat)
+    report = {'environment': environment(), 'args': vars(args), 'cases': results}
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = confirm_regressions(results, baseline, args.tolerance, args.abs_floor, args.confirm, args.seed, args.repeat)
+        for res, metric, current, ref in regressions:
+            print("REGRESSION {} {}: {:.2f} vs baseline {:.2f}".format(case_name(res), metric, current, ref))
+        if regressions:
+            return 1
+        print("no regressions against {}".format(args.baseline))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,104 @@
+"""
+accuracy of the single precision path (dtype=np.float32) against the default float64 one
+
+Every signal of the shipped corpora (data/gauss, data/inst, data/omt) runs through the matrix mode of the
+detectors (batched=True) once in float64 and once with dtype=np.float32, with the same per-signal seed.
+Reported per method and corpus:
+    - flips: signals whose detected flag differs
+    - period diffs: signals detected by both with different periods
+    - speedup of the float32 run
+
+Usage (from the repository root):
+    python -m benchmarks.float32_accuracy --corpora gauss inst omt
+    python -m benchmarks.float32_accuracy --methods bcndetection --step 10
+"""
+import os
+import sys
+import glob
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from src.bcndetection import bcndetection_batch
+from src.baywatch import baywatch_batch
+
+
+### method name -> matrix mode of the detector
+METHODS = {
+    'bcndetection': bcndetection_batch,
+    'baywatch': baywatch_batch,
+}
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+
+CORPORA = ['gauss', 'inst', 'omt']
+
+
+### signal matrices of the parquet files of a corpus, every step-th signal
+def load_corpus(corpus, step=1, data_dir=DATA_DIR):
+    matrices = []
+    for fp in sorted(glob.glob(os.path.join(data_dir, corpus, '*.parquet'))):
+        signals = list(pd.read_parquet(fp)["tdf"])[::step]
+        if signals:
+            matrices.append(np.vstack([np.asarray(sig, dtype=float) for sig in signals]))
+    return matrices
+
+
+def run_dtype(batch, matrices, dtype, seed=0):
+    periods, detected = [], []
+    offset = 0
+    start = time.perf_counter()
+    for matrix in matrices:
+        keys = np.arange(offset, offset + len(matrix))
+        pers, det = batch(matrix, batched=True, seed=seed, keys=keys, dtype=dtype)
+        periods.extend(pers)
+        detected.extend(det)
+        offset += len(matrix)
+    return periods, np.asarray(detected, dtype=bool), time.perf_counter() - start
+
+
+def compare_float32(method, matrices, seed=0):
+    """
+    Parameters:
+        method (str): name of METHODS
+        matrices (list): signal matrices, e.g. load_corpus
+        seed (int): run seed, every signal gets its own stream keyed by its position
+    Returns:
+    dict: number of signals, detection flips, period differences and the float32 speedup
+    """
+    batch = METHODS[method]
+    ref_periods, ref_detected, ref_time = run_dtype(batch, matrices, float, seed)
+    periods, detected, elapsed = run_dtype(batch, matrices, np.float32, seed)
+    both = ref_detected & detected
+    period_diffs = sum(len(a) != len(b) or not np.allclose(a, b)
+                       for a, b, d in zip(periods, ref_periods, both) if d)
+    return {
+        'method': method,
+        'signals': len(detected),
+        'flips': int(np.sum(detected != ref_detected)),
+        'period_diffs': int(period_diffs),
+        'speedup': ref_time / elapsed,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--methods', nargs='+', default=list(METHODS), choices=list(METHODS))
+    parser.add_argument('--corpora', nargs='+', default=CORPORA)
+    parser.add_argument('--step', type=int, default=1, help='use every step-th signal of every file')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    for corpus in args.corpora:
+        matrices = load_corpus(corpus, args.step)
+        for method in args.methods:
+            res = compare_float32(method, matrices, args.seed)
+            print("{method:>12} {corpus:<6} signals={signals:<5} flips {flips:<4} period diffs {period_diffs:<4} "
+                  "float32 speedup {speedup:5.2f}x".format(corpus=corpus, **res), flush=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
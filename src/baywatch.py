@@ -4,21 +4,14 @@ from sklearn import mixture
 import multiprocessing
 
 from .helpfns import *
+from .runner import run_parallel, dispatch_wrap
+from .gmm1d import gmm1d_select, gmm1d_select_batch
 
 ### random permute data and find PSD threshold as the (permute_cnt * Confidence)-th Maximum PSD value
 #def get_psd_threshold(data, permute_cnt=20, C=0.95, sample_freq=1):
-def baywatch_permute(data, permute_cnt=20, C=0.95, sample_freq=1):
-    max_psd = []
-    for i in range(permute_cnt):
-        permuted_data = np.random.permutation(data)
-        _, t_psd = compute_psd(permuted_data, sample_freq)
-        max_power = np.max(t_psd)
-        max_psd.append(max_power)
-        
-    rank = int(C * permute_cnt) - 1
-    max_psd.sort()
-    psd_threshold = max_psd[rank]
-    return psd_threshold
+### permutation_threshold with 20 permutations by default
+def baywatch_permute(data, permute_cnt=20, C=0.95, sample_freq=1, **kwargs):
+    return permutation_threshold(data, permute_cnt, C, sample_freq, **kwargs)
 
 
 #### pvalue pruning 
@@ -30,7 +23,11 @@ def pvalue_pruning(tsintervals, potential_freqs, alpha=0.05):
             res.append(period)
     return res
 
-def gmm_fitting(tsintervals):
+### random_state seeds the k-means initialization of the mixtures
+### engine='fast' fits the same 1..3 component mixtures with the vectorized 1-D EM of gmm1d (deterministic init, no random_state)
+def gmm_fitting(tsintervals, random_state=None, engine='sklearn'):
+    if engine == 'fast':
+        return gmm1d_select(tsintervals, min(3, len(tsintervals) - 1))
     bic = []
     cntsamples = len(tsintervals)
     n_components_range = range(1, min(4, cntsamples))
@@ -38,7 +35,7 @@ def gmm_fitting(tsintervals):
     lowest_bic = np.infty
     for n_components in n_components_range:
         # Fit a Gaussian mixture with EM
-        gmm = mixture.GaussianMixture(n_components=n_components,)
+        gmm = mixture.GaussianMixture(n_components=n_components, random_state=random_state)
         gmm.fit(X)
         bic.append(gmm.bic(X))
 
@@ -48,72 +45,220 @@ def gmm_fitting(tsintervals):
     return best_gmm.means_.flatten()
 
 
-def baywatch_method(signals):
+def baywatch_method(signals, batched=False, cache=None, adaptive=False, counter=None, rng=None, dtype=float, gmm='sklearn'):
     """
     implementation of periodicity detection algorithm in ''Baywatch: robust beaconing detection to identify infected hosts in large-scale enterprise networks''
     
+    Parameters:
+        signals (array, SparseSignal or SpectralWorkspace): input time series
+        batched (bool): compute the permutation threshold with the batched FFT path
+        cache (PSDThresholdCache): optional permutation threshold cache
+        adaptive (bool): stop the permutation test early once its outcome is settled
+        counter (dict): optional instrumentation counter, accumulates 'permutations' drawn, 'signals', 'detected',
+            the early exits 'exit.<stage>', the 'candidates' / 'high_freq_candidates' periods
+            and the per-stage wall time 'time.<stage>' in seconds
+        rng (np.random.Generator): random generator of this signal, the global np.random state if None
+        dtype: np.float32 computes the periodogram, ACF and permutation FFTs in single precision
+        gmm (str): 'fast' fits the interval mixtures with the vectorized 1-D EM of gmm1d instead of sklearn
     Returns: 
     array: list of detected periods (empty if the method does not report specific detected periods)
     bool: True if the signal is periodic else False
     """
     periods = []
     detected = False
+    add_count(counter, 'signals')
 
-    #sigcnt = len(signals[signals>0])
-    sigcnt = len([i for i in signals if i > 0])
+    ws = as_workspace(signals, dtype=dtype)
+    #sigcnt = len([i for i in signals if i > 0])
+    sigcnt = ws.sigcnt
     if sigcnt < 3:
+        add_count(counter, 'exit.sigcnt')
         return periods, detected
         
-    freq, psd = compute_psd(signals)
-    psd_threshold = baywatch_permute(signals)
+    signals = ws.data
+    with stage_timer(counter, 'psd'):
+        freq, psd = ws.psd
+    with stage_timer(counter, 'permute'):
+        psd_threshold = baywatch_permute(signals, batched=batched, cache=cache, adaptive=adaptive, psd=psd, counter=counter, rng=rng, dtype=dtype)
     potential_pers = get_potential_periods(freq, psd, psd_threshold)
+    add_count(counter, 'candidates', len(potential_pers))
 
     # if no valid periodicity
     if len(potential_pers) == 0:
+        add_count(counter, 'exit.no_candidates')
         return periods, detected
 
-    ts_intervals = get_ts_intervals(signals)
-    min_ts = get_min_tsinterval(ts_intervals) 
+    ts_intervals = ws.ts_intervals
+    min_ts = ws.min_tsinterval
     high_freq_periods = high_freq_pruning(potential_pers, min_ts)
+    add_count(counter, 'high_freq_candidates', len(high_freq_periods))
     
     # if no valid periodicity
     if len(high_freq_periods) == 0:
+        add_count(counter, 'exit.high_freq')
         return periods, detected
     
     ### pvalue pruning
-    pvalue_pruned_periods = pvalue_pruning(ts_intervals, high_freq_periods)
+    with stage_timer(counter, 'pvalue'):
+        pvalue_pruned_periods = pvalue_pruning(ts_intervals, high_freq_periods)
     # if no valid periodicity
     if len(pvalue_pruned_periods) == 0:
+        add_count(counter, 'exit.pvalue')
         return periods, detected
     
     ### gmm fitting
-    gmm_pers = gmm_fitting(ts_intervals)
+    with stage_timer(counter, 'gmm'):
+        gmm_pers = gmm_fitting(ts_intervals, None if rng is None else int(rng.integers(2**31)), engine=gmm)
     # if no valid periodicity
     if len(gmm_pers) == 0:
+        add_count(counter, 'exit.gmm')
         return periods, detected
     
     ## acf verification
-    acf_peaks = get_autocorr_peaks(signals)
+    with stage_timer(counter, 'acf'):
+        acf_peaks = ws.acf_peaks
     periods = acf_filtered_periodicity(gmm_pers, acf_peaks)
     if len(periods) > 0:
         detected = True
+        add_count(counter, 'detected')
+    else:
+        add_count(counter, 'exit.acf')
         
     return periods, detected
 
+
+
+def baywatch_batch(matrix, batched=True, cache=None, adaptive=False, counter=None, seed=None, keys=None, dtype=float, gmm='sklearn'):
+    """
+    matrix mode of baywatch_method over a batch of equal-length signals
+    the sigcnt gate, periodograms, candidate extraction, high frequency pruning, the t-tests of all candidate periods
+    (from the interval means and variances), the ACFs and the ACF filter are computed for all rows at once,
+    the permutations of all rows share the FFTs (batched=True without cache / adaptive) and gmm='fast' fits
+    all interval mixtures together. Every row draws from its own signal_rng(seed, key), so with a seed the
+    results match baywatch_method row by row.
+    
+    Parameters:
+        matrix (2-D array): one signal per row
+        batched (bool): compute the permutation thresholds with the batched FFT path
+        cache (PSDThresholdCache): optional permutation threshold cache
+        adaptive (bool): stop the permutation tests early once their outcome is settled
+        counter (dict): optional instrumentation counter, same counts and stage times as baywatch_method
+        seed (int): run seed, every row gets signal_rng(seed, key) with its keys entry (or its content) as key
+        keys (array): optional pair keys of the rows
+        dtype: np.float32 computes the periodograms, ACFs and permutation FFTs in single precision
+        gmm (str): 'fast' fits the interval mixtures with gmm1d_select_batch instead of sklearn
+    Returns: 
+    list: list of detected periods for every row
+    array: bool array, True if the row is periodic else False
+    """
+    matrix = np.atleast_2d(np.asarray(matrix, dtype=float))
+    periods = [[] for _ in range(matrix.shape[0])]
+    detected = np.zeros(matrix.shape[0], dtype=bool)
+    add_count(counter, 'signals', matrix.shape[0])
+    
+    rows = np.flatnonzero((matrix > 0).sum(axis=1) >= 3)
+    add_count(counter, 'exit.sigcnt', matrix.shape[0] - len(rows))
+    if len(rows) == 0:
+        return periods, detected
+    
+    signals = matrix[rows]
+    with stage_timer(counter, 'psd'):
+        freq, psd = compute_psd_batch(signals, dtype=dtype)
+    if seed is None:
+        rngs = [None] * len(rows)
+    else:
+        rngs = [signal_rng(seed, matrix[i] if keys is None else keys[i]) for i in rows]
+    with stage_timer(counter, 'permute'):
+        if batched and cache is None and not adaptive:
+            psd_threshold = permute_psd_threshold_batch(signals, 20, rngs=rngs, dtype=dtype)
+            add_count(counter, 'permutations', 20 * len(rows))
+        else:
+            psd_threshold = np.array([baywatch_permute(sig, batched=batched, cache=cache, adaptive=adaptive, psd=sig_psd, counter=counter, rng=rng, dtype=dtype)
+                                      for sig, sig_psd, rng in zip(signals, psd, rngs)])
+    
+    # time intervals of every row, sigcnt >= 3 leaves at least 2 per row
+    intervals, iv_rows = get_ts_intervals_batch(signals)
+    sizes = np.bincount(iv_rows, minlength=len(rows))
+    means = np.bincount(iv_rows, intervals, len(rows)) / sizes
+    variances = np.bincount(iv_rows, (intervals - means[iv_rows]) ** 2, len(rows)) / (sizes - 1)
+    
+    # potential periods and high frequency pruning
+    with np.errstate(divide='ignore'):
+        freq_pers = 1 / freq
+    potential = (psd > psd_threshold[:, None]) & (freq_pers < 720)
+    candidates = potential & (freq_pers >= get_min_tsinterval_batch(signals)[:, None])
+    
+    ### pvalue pruning of all candidate periods at once
+    with stage_timer(counter, 'pvalue'):
+        r, c = np.nonzero(candidates)
+        pvalue = ttest_1samp_batch(means[r], variances[r], sizes[r], freq_pers[c])
+        pruned = np.zeros_like(candidates)
+        pruned[r, c] = (pvalue > 0.05) | np.isnan(pvalue)
+    valid = np.flatnonzero(pruned.any(axis=1))
+    if counter is not None:
+        has_potential = int(potential.any(axis=1).sum())
+        has_candidates = int(candidates.any(axis=1).sum())
+        add_count(counter, 'candidates', int(potential.sum()))
+        add_count(counter, 'high_freq_candidates', int(candidates.sum()))
+        add_count(counter, 'exit.no_candidates', len(rows) - has_potential)
+        add_count(counter, 'exit.high_freq', has_potential - has_candidates)
+        add_count(counter, 'exit.pvalue', has_candidates - len(valid))
+    if len(valid) == 0:
+        return periods, detected
+    
+    ### gmm fitting
+    ts_intervals = np.split(intervals, np.cumsum(sizes)[:-1])
+    with stage_timer(counter, 'gmm'):
+        if gmm == 'fast':
+            gmm_pers = gmm1d_select_batch([ts_intervals[i] for i in valid])
+        else:
+            gmm_pers = [gmm_fitting(ts_intervals[i], None if rngs[i] is None else int(rngs[i].integers(2**31))) for i in valid]
+    fitted = [j for j, pers in enumerate(gmm_pers) if len(pers) > 0]
+    add_count(counter, 'exit.gmm', len(valid) - len(fitted))
+    valid = valid[fitted]
+    if len(valid) == 0:
+        return periods, detected
+    
+    ## acf verification
+    with stage_timer(counter, 'acf'):
+        acf = autocorr_batch(signals[valid], dtype=dtype)
+        acf_peaks = [get_acf_peaks(acf_ts) for acf_ts in acf]
+        acf_pers = acf_filtered_periodicity_batch([gmm_pers[j] for j in fitted], acf_peaks)
+    for pers, i in zip(acf_pers, valid):
+        periods[rows[i]] = pers
+        detected[rows[i]] = len(pers) > 0
+    if counter is not None:
+        add_count(counter, 'detected', int(detected.sum()))
+        add_count(counter, 'exit.acf', len(valid) - int(detected.sum()))
+    
+    return periods, detected
+
     
-def baywatch_wrap(df):
+def baywatch_wrap(df, batch=False, result_cache=None, dedup=False, **kwargs):
     """
-    wrap for data frame processing
+    wrap for data frame processing, kwargs are passed to baywatch_method
+    batch=True processes the whole frame with baywatch_batch (equal-length signals)
+    seed (int) and key_col (str) give every signal its own rng (see apply_method)
     """
-    df['periods'], df['detected'] = zip(*df["tdf"].apply(baywatch_method))
+    resdf = dispatch_wrap(df, baywatch_wrap, 'baywatch_method', ['periods', 'detected'], result_cache, dedup, batch=batch, **kwargs)
+    if resdf is not None:
+        return resdf
+    if batch:
+        key_col = kwargs.pop('key_col', None)
+        if key_col is not None:
+            kwargs['keys'] = df[key_col].values
+        periods, detected = baywatch_batch(np.vstack(df["tdf"].values), **kwargs)
+        df['periods'], df['detected'] = periods, detected
+        return df
+    df['periods'], df['detected'] = zip(*apply_method(df, baywatch_method, **kwargs))
     return df
 
-def mltproc_baywatch_wrap(df, maxproc = 16):
+def mltproc_baywatch_wrap(df, maxproc = 16, result_cache=None, dedup=False, chunksize=None, **kwargs):
     """
     wrap func for multiprocessing
     """    
-    pool = multiprocessing.Pool(processes = maxproc)    
-    df_lst = np.array_split(df, maxproc)
-    res = pool.map(baywatch_wrap, df_lst)
-    resdf = pd.concat(res)
-    return resdf
\ No newline at end of file
+    resdf = dispatch_wrap(df, mltproc_baywatch_wrap, 'baywatch_method', ['periods', 'detected'], result_cache, dedup,
+                          maxproc=maxproc, chunksize=chunksize, **kwargs)
+    if resdf is not None:
+        return resdf
+    return run_parallel(df, baywatch_wrap, ['periods', 'detected'], maxproc, chunksize, **kwargs)
\ No newline at end of file
@@ -4,30 +4,26 @@ import emd
 import multiprocessing
 
 from .helpfns import *
+from .statsbased import stats_score
+from .upnsca import upnsca_score
+from .runner import run_parallel, dispatch_wrap
 
 
 
 ### random permute data and find PSD threshold as the (permute_cnt * Confidence)-th Maximum PSD value
-def bcn_permute(data, permute_cnt=100, C=0.95, sample_freq=1):
-    max_psd = []
-    for i in range(permute_cnt):
-        permuted_data = np.random.permutation(data)
-        _, t_psd = compute_psd(permuted_data, sample_freq)
-        max_power = np.max(t_psd)
-        max_psd.append(max_power)
-        
-    rank = int(C * permute_cnt) - 1
-    max_psd.sort()
-    psd_threshold = max_psd[rank]
-    return psd_threshold
+### permutation_threshold with 100 permutations by default
+def bcn_permute(data, permute_cnt=100, C=0.95, sample_freq=1, **kwargs):
+    return permutation_threshold(data, permute_cnt, C, sample_freq, **kwargs)
 
 
-def emd_compose(signals):
+### counter['emd_fallback'] counts the signals returned undecomposed because the sift failed
+def emd_compose(signals, counter=None):
     imf_opts = {'sd_thresh': 0.05}
     try: 
         emdsig = emd.sift.sift(signals, imf_opts=imf_opts, max_imfs=2)[:,0]
         return emdsig
     except:
+        add_count(counter, 'emd_fallback')
         return signals
 
 
@@ -43,63 +39,231 @@ def bcn_filtering(potential_periods, autocorr_peaks, threshold=2):
             true_period.append(period)
     return true_period
     
-def bcndetection_method(signals):
+def bcndetection_method(signals, batched=False, cache=None, adaptive=False, counter=None, rng=None, dtype=float):
     """
     implementation of our periodicity detection algorithm
     
+    Parameters:
+        signals (array, SparseSignal or SpectralWorkspace): input time series
+        batched (bool): compute the permutation threshold with the batched FFT path
+        cache (PSDThresholdCache): optional permutation threshold cache
+        adaptive (bool): stop the permutation test early once its outcome is settled
+        counter (dict): optional instrumentation counter, accumulates 'permutations' drawn, 'signals', 'detected',
+            the early exits 'exit.<stage>', 'emd_fallback', the 'candidates' / 'high_freq_candidates' periods
+            and the per-stage wall time 'time.<stage>' in seconds
+        rng (np.random.Generator): random generator of this signal, the global np.random state if None
+        dtype: np.float32 computes the periodogram, ACF and permutation FFTs in single precision
     Returns: 
     array: list of detected periods (empty if the method does not report specific detected periods)
     bool: True if the signal is periodic else False
     """
     periods = []
     detected = False
+    add_count(counter, 'signals')
     
-    #sigcnt = len(signals[signals>0])
-    sigcnt = len([i for i in signals if i > 0])
+    ws = as_workspace(signals, dtype=dtype)
+    #sigcnt = len([i for i in signals if i > 0])
+    sigcnt = ws.sigcnt
     if sigcnt < 3:
+        add_count(counter, 'exit.sigcnt')
         return periods, detected
     
-    # decompose
-    signals = emd_compose(signals)
-    freq, psd = compute_psd(signals)
-    psd_threshold = bcn_permute(signals)
+    # decompose, the workspace is reused if EMD falls back to the original signal
+    with stage_timer(counter, 'emd'):
+        signals = emd_compose(ws.data, counter)
+    if signals is not ws.data:
+        ws = SpectralWorkspace(signals, ws.sample_freq, dtype)
+    with stage_timer(counter, 'psd'):
+        freq, psd = ws.psd
+    with stage_timer(counter, 'permute'):
+        psd_threshold = bcn_permute(signals, batched=batched, cache=cache, adaptive=adaptive, psd=psd, counter=counter, rng=rng, dtype=dtype)
     potential_pers = get_potential_periods(freq, psd, psd_threshold)
+    add_count(counter, 'candidates', len(potential_pers))
     
     # if no valid periodicity
     if len(potential_pers) == 0:
+        add_count(counter, 'exit.no_candidates')
         return periods, detected
 
-    ts_intervals = get_ts_intervals(signals)
-    min_ts = get_min_tsinterval(ts_intervals) 
+    ts_intervals = ws.ts_intervals
+    min_ts = ws.min_tsinterval
     high_freq_periods = high_freq_pruning(potential_pers, min_ts)
+    add_count(counter, 'high_freq_candidates', len(high_freq_periods))
     
     # if no valid periodicity
     if len(high_freq_periods) == 0:
+        add_count(counter, 'exit.high_freq')
         return periods, detected
     
     ## acf verification
-    acf_peaks = get_autocorr_peaks(signals)
+    with stage_timer(counter, 'acf'):
+        acf_peaks = ws.acf_peaks
     periods = bcn_filtering(high_freq_periods, acf_peaks)
     if len(periods) > 0:
         detected = True
+        add_count(counter, 'detected')
+    else:
+        add_count(counter, 'exit.acf')
         
     return periods, detected
 
+
+
+### exit stages of bcndetection_cascade, cheapest first
+CASCADE_STAGES = ['sigcnt', 'cv', 'energy', 'peak', 'full']
+
+def bcndetection_cascade(signals, cv_max=2.0, energy_min=0.3, peak_ratio_min=4.0, **kwargs):
+    """
+    cheap-first cascade over bcndetection_method
+    obviously aperiodic signals are rejected with scores that cost one FFT at most, only the remaining
+    ambiguous signals pay for EMD and the permutation test. A gate set to None is disabled.
+    The default gates do not drop any detection of bcndetection_method on the data/ corpora.
+    
+    Parameters:
+        signals (array, SparseSignal or SpectralWorkspace): input time series
+        cv_max (float): reject if the coefficient of variation of the time intervals (stats_method score) is larger
+        energy_min (float): reject if the top 10% spectral energy ratio (upnsca_method score) is smaller
+        peak_ratio_min (float): reject if the raw periodogram peak-to-mean ratio is smaller
+        **kwargs: passed to bcndetection_method
+    Returns: 
+    array: list of detected periods (empty if the method does not report specific detected periods)
+    bool: True if the signal is periodic else False
+    str: the stage the signal exited at, one of CASCADE_STAGES
+    """
+    ws = as_workspace(signals, dtype=kwargs.get('dtype', float))
+    stage = None
+    if ws.sigcnt < 3:
+        stage = 'sigcnt'
+    elif cv_max is not None and stats_score(ws) > cv_max:
+        stage = 'cv'
+    elif energy_min is not None and upnsca_score(ws) < energy_min:
+        stage = 'energy'
+    elif peak_ratio_min is not None and psd_peak_ratio(ws.psd[1]) < peak_ratio_min:
+        stage = 'peak'
+    if stage is not None:
+        add_count(kwargs.get('counter'), 'exit.cascade_' + stage)
+        return [], False, stage
+    
+    periods, detected = bcndetection_method(ws, **kwargs)
+    return periods, detected, 'full'
+
+### number of signals that exited at each cascade stage
+def cascade_stage_counts(df):
+    return df['stage'].value_counts().reindex(CASCADE_STAGES, fill_value=0)
+
+
+def bcndetection_batch(matrix, batched=True, cache=None, adaptive=False, counter=None, seed=None, keys=None, dtype=float):
+    """
+    matrix mode of bcndetection_method over a batch of equal-length signals
+    the sigcnt gate, periodograms, candidate extraction, high frequency pruning and ACF are computed for all rows at once,
+    EMD sifting and the permutation thresholds are computed per row in row order (same random stream as row-by-row processing)
+    
+    Parameters:
+        matrix (2-D array): one signal per row
+        batched (bool): compute the permutation thresholds with the batched FFT path
+        cache (PSDThresholdCache): optional permutation threshold cache
+        adaptive (bool): stop the permutation tests early once their outcome is settled
+        counter (dict): optional counter, 'permutations' accumulates the number of permutations drawn
+        seed (int): run seed, every row gets signal_rng(seed, key) with its keys entry (or its content) as key
+        keys (array): optional pair keys of the rows
+        dtype: np.float32 computes the periodograms, ACFs and permutation FFTs in single precision
+    Returns: 
+    list: list of detected periods for every row
+    array: bool array, True if the row is periodic else False
+    """
+    matrix = np.atleast_2d(np.asarray(matrix, dtype=float))
+    periods = [[] for _ in range(matrix.shape[0])]
+    detected = np.zeros(matrix.shape[0], dtype=bool)
+    add_count(counter, 'signals', matrix.shape[0])
+    
+    rows = np.flatnonzero((matrix > 0).sum(axis=1) >= 3)
+    add_count(counter, 'exit.sigcnt', matrix.shape[0] - len(rows))
+    if len(rows) == 0:
+        return periods, detected
+    
+    # decompose
+    with stage_timer(counter, 'emd'):
+        signals = np.vstack([emd_compose(matrix[i], counter) for i in rows])
+    with stage_timer(counter, 'psd'):
+        freq, psd = compute_psd_batch(signals, dtype=dtype)
+    if seed is None:
+        rngs = [None] * len(rows)
+    else:
+        rngs = [signal_rng(seed, matrix[i] if keys is None else keys[i]) for i in rows]
+    with stage_timer(counter, 'permute'):
+        psd_threshold = np.array([bcn_permute(sig, batched=batched, cache=cache, adaptive=adaptive, psd=sig_psd, counter=counter, rng=rng, dtype=dtype)
+                                  for sig, sig_psd, rng in zip(signals, psd, rngs)])
+    
+    # potential periods and high frequency pruning
+    with np.errstate(divide='ignore'):
+        freq_pers = 1 / freq
+    potential = (psd > psd_threshold[:, None]) & (freq_pers < 720)
+    candidates = potential & (freq_pers >= get_min_tsinterval_batch(signals)[:, None])
+    
+    ## acf verification
+    valid = np.flatnonzero(candidates.any(axis=1))
+    if counter is not None:
+        has_potential = int(potential.any(axis=1).sum())
+        add_count(counter, 'candidates', int(potential.sum()))
+        add_count(counter, 'high_freq_candidates', int(candidates.sum()))
+        add_count(counter, 'exit.no_candidates', len(rows) - has_potential)
+        add_count(counter, 'exit.high_freq', has_potential - len(valid))
+    if len(valid) == 0:
+        return periods, detected
+    
+    with stage_timer(counter, 'acf'):
+        acf = autocorr_batch(signals[valid], dtype=dtype)
+        acf_peaks = [get_acf_peaks(acf_ts) for acf_ts in acf]
+    for peaks, i in zip(acf_peaks, valid):
+        high_freq_periods = freq_pers[candidates[i]]
+        if len(peaks) == 0:
+            continue
+        dist = np.abs(high_freq_periods[:, None] - peaks[None, :]).min(axis=1)
+        periods[rows[i]] = list(high_freq_periods[dist <= 2])
+        detected[rows[i]] = len(periods[rows[i]]) > 0
+    if counter is not None:
+        add_count(counter, 'detected', int(detected.sum()))
+        add_count(counter, 'exit.acf', len(valid) - int(detected.sum()))
+    
+    return periods, detected
+
     
-def bcndetection_wrap(df):
+def bcndetection_wrap(df, batch=False, cascade=False, result_cache=None, dedup=False, **kwargs):
     """
-    wrap for data frame processing
+    wrap for data frame processing, kwargs are passed to bcndetection_method
+    batch=True processes the whole frame with bcndetection_batch (equal-length signals)
+    cascade=True runs bcndetection_cascade and adds the exit 'stage' column (see cascade_stage_counts)
+    seed (int) and key_col (str) give every signal its own rng (see apply_method)
+    dedup=True runs every distinct signal once (see dedup_run)
     """
-    df['periods'], df['detected'] = zip(*df["tdf"].apply(bcndetection_method))
+    columns = ['periods', 'detected', 'stage'] if cascade else ['periods', 'detected']
+    method_name = 'bcndetection_cascade' if cascade else 'bcndetection_method'
+    resdf = dispatch_wrap(df, bcndetection_wrap, method_name, columns, result_cache, dedup, batch=batch, cascade=cascade, **kwargs)
+    if resdf is not None:
+        return resdf
+    if cascade:
+        df['periods'], df['detected'], df['stage'] = zip(*apply_method(df, bcndetection_cascade, **kwargs))
+        return df
+    if batch:
+        key_col = kwargs.pop('key_col', None)
+        if key_col is not None:
+            kwargs['keys'] = df[key_col].values
+        periods, detected = bcndetection_batch(np.vstack(df["tdf"].values), **kwargs)
+        df['periods'], df['detected'] = periods, detected
+        return df
+    df['periods'], df['detected'] = zip(*apply_method(df, bcndetection_method, **kwargs))
     return df
 
-def mltproc_bcndetection_wrap(df, maxproc = 16):
+def mltproc_bcndetection_wrap(df, maxproc = 16, result_cache=None, dedup=False, chunksize=None, **kwargs):
     """
     wrap func for multiprocessing
     """    
-    pool = multiprocessing.Pool(processes = maxproc)    
-    df_lst = np.array_split(df, maxproc)
-    res = pool.map(bcndetection_wrap, df_lst)
-    resdf = pd.concat(res)
-    return resdf
+    cascade = kwargs.get('cascade', False)
+    columns = ['periods', 'detected', 'stage'] if cascade else ['periods', 'detected']
+    method_name = 'bcndetection_cascade' if cascade else 'bcndetection_method'
+    resdf = dispatch_wrap(df, mltproc_bcndetection_wrap, method_name, columns, result_cache, dedup,
+                          maxproc=maxproc, chunksize=chunksize, **kwargs)
+    if resdf is not None:
+        return resdf
+    return run_parallel(df, bcndetection_wrap, columns, maxproc, chunksize, **kwargs)
 
@@ -0,0 +1,155 @@
+import numpy as np
+from scipy.special import logsumexp
+
+
+### defaults of sklearn.mixture.GaussianMixture
+REG_COVAR = 1e-6
+TOL = 1e-3
+MAX_ITER = 100
+
+_EPS = 10 * np.finfo(float).eps
+
+
+### pad a list of 1-D samples into a NaN padded matrix
+def pad_samples(samples):
+    samples = [np.asarray(x, dtype=float).ravel() for x in samples]
+    x = np.full((len(samples), max([len(s) for s in samples] + [1])), np.nan)
+    for i, s in enumerate(samples):
+        x[i, :len(s)] = s
+    return x
+
+
+### 1-D k-means (Lloyd) of every row from the given centers, padded entries (NaN) are ignored
+### returns the one-hot cluster assignment, the initial responsibilities of the EM
+def kmeans_resp(x, centers, max_iter=MAX_ITER):
+    mask = ~np.isnan(x)
+    xz = np.where(mask, x, 0.)
+    k = centers.shape[1]
+    labels = None
+    for _ in range(max_iter):
+        dist = np.abs(np.where(mask, x, np.inf)[:, :, None] - centers[:, None, :])
+        new_labels = np.argmin(dist, axis=2)
+        if labels is not None and np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+        onehot = (labels[:, :, None] == np.arange(k)) & mask[:, :, None]
+        cnt = onehot.sum(axis=1)
+        sums = (onehot * xz[:, :, None]).sum(axis=1)
+        centers = np.where(cnt > 0, sums / np.maximum(cnt, 1), centers)
+    return ((labels[:, :, None] == np.arange(k)) & mask[:, :, None]).astype(float)
+
+
+### deterministic initial centers: the means of k equal-count slices of the sorted samples
+def quantile_centers(x, k):
+    srt = np.sort(x, axis=1)
+    n = (~np.isnan(x)).sum(axis=1)
+    edges = np.round(np.outer(n, np.arange(k + 1) / k)).astype(int)
+    csum = np.concatenate([np.zeros((len(x), 1)), np.nancumsum(srt, axis=1)], axis=1)
+    rows = np.arange(len(x))[:, None]
+    cnt = np.maximum(np.diff(edges, axis=1), 1)
+    return (csum[rows, edges[:, 1:]] - csum[rows, edges[:, :-1]]) / cnt
+
+
+### warm start: centers of the k-1 component fit plus a new center splitting the widest component at mean + sd
+def split_centers(means, variances, weights):
+    widest = np.argmax(weights * variances, axis=1)
+    rows = np.arange(len(means))
+    new = means[rows, widest] + np.sqrt(variances[rows, widest])
+    return np.sort(np.concatenate([means, new[:, None]], axis=1), axis=1)
+
+
+def _m_step(x, mask, resp, reg_covar):
+    resp = resp * mask[:, :, None]
+    xz = np.where(mask, x, 0.)
+    nk = resp.sum(axis=1) + _EPS
+    means = (resp * xz[:, :, None]).sum(axis=1) / nk
+    diff = np.where(mask[:, :, None], xz[:, :, None] - means[:, None, :], 0.)
+    variances = (resp * diff ** 2).sum(axis=1) / nk + reg_covar
+    weights = nk / mask.sum(axis=1, keepdims=True)
+    return weights, means, variances
+
+
+### mean log-likelihood of every row and the log responsibilities
+def _e_step(x, mask, weights, means, variances):
+    xz = np.where(mask, x, 0.)
+    log_prob = -.5 * (np.log(2 * np.pi) + np.log(variances[:, None, :])
+                      + (xz[:, :, None] - means[:, None, :]) ** 2 / variances[:, None, :]) + np.log(weights[:, None, :])
+    log_norm = logsumexp(log_prob, axis=2)
+    lower_bound = np.where(mask, log_norm, 0.).sum(axis=1) / mask.sum(axis=1)
+    return lower_bound, log_prob - log_norm[:, :, None]
+
+
+def gmm1d_em(x, resp, reg_covar=REG_COVAR, tol=TOL, max_iter=MAX_ITER):
+    """
+    EM of a 1-D gaussian mixture for every row of a NaN padded sample matrix, same updates and stopping
+    rule as sklearn.mixture.GaussianMixture (change of the mean log-likelihood < tol), converged rows are frozen
+
+    Parameters:
+        x (2-D array): samples, one signal per row, NaN padded
+        resp (3-D array): initial responsibilities, rows x samples x components
+    Returns:
+    array: weights, means, variances (rows x components) and the mean log-likelihood of every row
+    """
+    mask = ~np.isnan(x)
+    weights, means, variances = _m_step(x, mask, resp, reg_covar)
+    lower_bound = np.full(len(x), -np.inf)
+    active = np.ones(len(x), dtype=bool)
+    for _ in range(max_iter):
+        idx = np.flatnonzero(active)
+        if len(idx) == 0:
+            break
+        lb, log_resp = _e_step(x[idx], mask[idx], weights[idx], means[idx], variances[idx])
+        weights[idx], means[idx], variances[idx] = _m_step(x[idx], mask[idx], np.exp(log_resp), reg_covar)
+        active[idx[np.abs(lb - lower_bound[idx]) < tol]] = False
+        lower_bound[idx] = lb
+    lower_bound, _ = _e_step(x, mask, weights, means, variances)
+    return weights, means, variances, lower_bound
+
+
+### BIC as in GaussianMixture.bic: k means, k variances and k - 1 weights in 1-D
+def gmm1d_bic(lower_bound, n, k):
+    return -2 * lower_bound * n + (3 * k - 1) * np.log(n)
+
+
+def gmm1d_select_batch(samples, max_components=3, init='warm', reg_covar=REG_COVAR, tol=TOL, max_iter=MAX_ITER):
+    """
+    fast replacement of gmm_fitting for many signals at once: fit 1..max_components component mixtures to the
+    samples of every signal (k < number of samples, as gmm_fitting) and keep the means of the lowest BIC model
+
+    Parameters:
+        samples (list): 1-D sample arrays, e.g. the time intervals of every signal
+        max_components (int): largest number of components tried
+        init (str): 'quantile' seeds a 1-D k-means with the means of k equal-count slices of the sorted samples,
+            'warm' seeds it with the k-1 component fit plus a split of its widest component
+    Returns:
+    list: means of the selected mixture of every signal (empty for fewer than 2 samples)
+    """
+    x = pad_samples(samples)
+    n = (~np.isnan(x)).sum(axis=1)
+    best_bic = np.full(len(x), np.inf)
+    best_means = [np.empty(0) for _ in range(len(x))]
+    prev = None
+    for k in range(1, max_components + 1):
+        rows = np.flatnonzero(n > k)
+        if len(rows) == 0:
+            break
+        if init == 'warm' and prev is not None:
+            centers = split_centers(*(p[rows] for p in prev))
+        else:
+            centers = quantile_centers(x[rows], k)
+        resp = kmeans_resp(x[rows], centers, max_iter)
+        weights, means, variances, lower_bound = gmm1d_em(x[rows], resp, reg_covar, tol, max_iter)
+        bic = gmm1d_bic(lower_bound, n[rows], k)
+        for j, i in enumerate(rows):
+            if bic[j] < best_bic[i]:
+                best_bic[i] = bic[j]
+                best_means[i] = means[j]
+        prev = [np.full((len(x),) + a.shape[1:], np.nan) for a in (means, variances, weights)]
+        for p, a in zip(prev, (means, variances, weights)):
+            p[rows] = a
+    return best_means
+
+
+### fast gmm_fitting of a single signal
+def gmm1d_select(samples, max_components=3, **kwargs):
+    return gmm1d_select_batch([samples], max_components, **kwargs)[0]
@@ -1,12 +1,228 @@
+import time
+import hashlib
+import contextlib
 import numpy as np
-from scipy import signal, stats
+from functools import cached_property
+from scipy import fft, signal, stats
 
 
-### compute periodogram of the signal
-def compute_psd(data, sample_freq=1):
-    freq, pxx_den = signal.periodogram(data, sample_freq)
+### compute periodogram of the signal, same scaling as signal.periodogram (constant detrend, density, onesided)
+### every periodogram of the detectors (observed and permuted, looped and batched) goes through compute_psd_batch,
+### so the paths give bit-identical values and a peak tied with the permutation threshold is decided the same way
+def compute_psd(data, sample_freq=1, dtype=float):
+    return compute_psd_batch(data, sample_freq, dtype)
+
+### compute periodogram of every row of a 2-D signal matrix with one real FFT
+### same scaling as signal.periodogram (constant detrend, density, onesided)
+### dtype=np.float32 runs the FFT in single precision (scipy.fft keeps float32/complex64)
+def compute_psd_batch(data, sample_freq=1, dtype=float):
+    data = np.asarray(data, dtype=dtype)
+    n = data.shape[-1]
+    spec = fft.rfft(data - data.mean(axis=-1, keepdims=True), axis=-1)
+    return psd_from_rfft(spec, n, sample_freq)
+
+### onesided density periodogram from the rfft of an n-point (detrended) signal
+def psd_from_rfft(spec, n, sample_freq=1):
+    pxx_den = (spec.real ** 2 + spec.imag ** 2) / (sample_freq * n)
+    if n % 2:
+        pxx_den[..., 1:] *= 2
+    else:
+        pxx_den[..., 1:-1] *= 2
+    freq = fft.rfftfreq(n, 1 / sample_freq)
     return freq, pxx_den
 
+### stable 64-bit hash of a pair key, or of the signal content when the key is a signal
+### (array bytes, signal_digest of a SparseSignal or of the signal behind a SpectralWorkspace)
+### numpy scalars hash like the equal python scalars, also inside tuple keys
+def stable_key_hash(key):
+    return int.from_bytes(hashlib.sha1(_key_payload(key)).digest()[:8], 'little')
+
+def _key_payload(key):
+    if isinstance(key, SpectralWorkspace):
+        key = key.sparse if key.sparse is not None else key.data
+    if isinstance(key, np.ndarray):
+        return np.ascontiguousarray(key, dtype=float).tobytes()
+    if isinstance(key, SparseSignal):
+        return signal_digest(key).encode()
+    return repr(_plain_key(key)).encode()
+
+### python scalars in place of numpy scalars, repr(np.int64(5)) is 'np.int64(5)' on numpy 2
+def _plain_key(key):
+    if isinstance(key, np.generic):
+        return key.item()
+    if isinstance(key, tuple):
+        return tuple(_plain_key(k) for k in key)
+    return key
+
+### per-signal random generator derived from a run seed and a stable signal/pair key
+### results only depend on (seed, key), not on worker count, chunking or processing order
+def signal_rng(seed, key):
+    return np.random.default_rng([seed, stable_key_hash(key)])
+
+### np.random.Generator if given, else the global np.random state
+def get_rng(rng=None):
+    return np.random if rng is None else rng
+
+### stack permute_cnt random permutations of data as rows of a matrix
+### draws the same random stream as calling rng.permutation(data) permute_cnt times
+def permutation_matrix(data, permute_cnt, rng=None):
+    rng = get_rng(rng)
+    data = np.asarray(data)
+    perm_idx = np.empty((permute_cnt, len(data)), dtype=np.intp)
+    for i in range(permute_cnt):
+        perm_idx[i] = rng.permutation(len(data))
+    return data[perm_idx]
+
+### batched permutation test: PSD threshold as the (permute_cnt * Confidence)-th Maximum PSD value
+def permute_psd_threshold(data, permute_cnt, C=0.95, sample_freq=1, rng=None, dtype=float):
+    data = np.asarray(data, dtype=dtype)
+    _, t_psd = compute_psd_batch(permutation_matrix(data, permute_cnt, rng), sample_freq, dtype)
+    max_psd = t_psd.max(axis=1)
+    rank = int(C * permute_cnt) - 1
+    return np.partition(max_psd, rank)[rank]
+
+### random permute data and find PSD threshold as the (permute_cnt * Confidence)-th Maximum PSD value
+### (the permutation test of bcn_permute and baywatch_permute, which only set their default permute_cnt)
+### batched=True builds all permutations at once and runs a single 2-D FFT (same threshold for the same random stream)
+### cache (PSDThresholdCache) reuses the threshold of signals with the same length and value histogram
+### (a missing threshold draws its permutations from cache.key_rng, not from rng)
+### adaptive=True stops drawing permutations once the outcome for the observed psd is settled (see sequential_psd_threshold),
+### its threshold depends on the observed psd and is never cached. counter['permutations'] counts the permutations drawn
+### rng (np.random.Generator) replaces the global np.random state
+### dtype=np.float32 runs the permuted periodograms in single precision
+def permutation_threshold(data, permute_cnt, C=0.95, sample_freq=1, batched=False, cache=None, adaptive=False, psd=None, counter=None, rng=None, dtype=float):
+    if cache is not None and not adaptive:
+        key = cache.make_key(data, permute_cnt, C, sample_freq, dtype)
+        psd_threshold = cache.get(key)
+        if psd_threshold is None:
+            psd_threshold = permutation_threshold(data, permute_cnt, C, sample_freq, batched, counter=counter, rng=cache.key_rng(key), dtype=dtype)
+            cache.put(key, psd_threshold)
+        return psd_threshold
+
+    if adaptive:
+        if psd is None:
+            _, psd = compute_psd(data, sample_freq, dtype)
+        psd_threshold, drawn = sequential_psd_threshold(data, psd, permute_cnt, C, sample_freq, rng=rng, dtype=dtype)
+        add_count(counter, 'permutations', drawn)
+        return psd_threshold
+
+    add_count(counter, 'permutations', permute_cnt)
+    if batched:
+        return permute_psd_threshold(data, permute_cnt, C, sample_freq, rng, dtype)
+
+    rng = get_rng(rng)
+    data = np.asarray(data, dtype=dtype)
+    max_psd = []
+    for i in range(permute_cnt):
+        permuted_data = rng.permutation(data)
+        _, t_psd = compute_psd(permuted_data, sample_freq, dtype)
+        max_power = np.max(t_psd)
+        max_psd.append(max_power)
+        
+    rank = int(C * permute_cnt) - 1
+    max_psd.sort()
+    psd_threshold = max_psd[rank]
+    return psd_threshold
+
+### permute_psd_threshold of every row of a 2-D signal matrix, the permutations of several rows share one 2-D FFT
+### (at most max_elements permuted values at a time), row i draws its permutations from rngs[i] in row order
+def permute_psd_threshold_batch(data, permute_cnt, C=0.95, sample_freq=1, rngs=None, dtype=float, max_elements=2**24):
+    data = np.atleast_2d(np.asarray(data, dtype=dtype))
+    rngs = [None] * len(data) if rngs is None else rngs
+    rank = int(C * permute_cnt) - 1
+    block = max(max_elements // (permute_cnt * max(data.shape[1], 1)), 1)
+    thresholds = np.empty(len(data))
+    for lo in range(0, len(data), block):
+        perms = np.vstack([permutation_matrix(row, permute_cnt, rng) for row, rng in zip(data[lo:lo + block], rngs[lo:lo + block])])
+        _, t_psd = compute_psd_batch(perms, sample_freq, dtype)
+        max_psd = t_psd.max(axis=1).reshape(-1, permute_cnt)
+        thresholds[lo:lo + block] = np.partition(max_psd, rank, axis=1)[:, rank]
+    return thresholds
+
+### one-sample t-test p-values from the mean, variance (ddof=1) and size of the sample sets, same as stats.ttest_1samp
+### of the samples against popmean (zero variance gives p=0 for popmean != mean and nan for popmean == mean)
+### all arguments broadcast, e.g. one entry per (sample set, popmean) pair
+def ttest_1samp_batch(means, variances, sizes, popmeans):
+    means, variances, sizes = (np.asarray(a, dtype=float) for a in (means, variances, sizes))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = (means - popmeans) / np.sqrt(variances / sizes)
+    return 2 * stats.t.sf(np.abs(t), sizes - 1)
+
+### sequential permutation test: permutations are drawn in blocks until the outcome of the full permute_cnt test is
+### settled for every bin with frequency > min_freq (the bins get_potential_periods can keep). A bin fails for sure once
+### more than permute_cnt - rank - 1 permuted maxima exceed it; otherwise the chance that the remaining draws would flip
+### its outcome is bounded by alpha, with the exceedance probability taken from a Gumbel fit of the permuted maxima.
+### Returns the threshold separating the passing from the failing bins and the number of permutations drawn.
+def sequential_psd_threshold(data, psd, permute_cnt, C=0.95, sample_freq=1, block=5, min_draws=10, alpha=1e-3, min_freq=1/720, rng=None, dtype=float):
+    data = np.asarray(data, dtype=dtype)
+    freq = fft.rfftfreq(len(data), 1 / sample_freq)
+    bins = np.asarray(psd)[freq > min_freq]
+    rank = int(C * permute_cnt) - 1
+    allowed = permute_cnt - rank - 1
+    
+    max_psd = np.empty(0)
+    while len(max_psd) < permute_cnt:
+        _, t_psd = compute_psd_batch(permutation_matrix(data, min(block, permute_cnt - len(max_psd)), rng), sample_freq, dtype)
+        max_psd = np.concatenate([max_psd, t_psd.max(axis=1)])
+        drawn = len(max_psd)
+        if drawn < min_draws or drawn == permute_cnt or len(bins) == 0:
+            continue
+        
+        exceed = drawn - np.searchsorted(np.sort(max_psd), bins, side='left')
+        scale = np.std(max_psd, ddof=1) * np.sqrt(6) / np.pi
+        if scale > 0:
+            p_exceed = stats.gumbel_r.sf(bins, np.mean(max_psd) - np.euler_gamma * scale, scale)
+        else:
+            p_exceed = (bins <= max_psd[0]).astype(float)
+        remaining = permute_cnt - drawn
+        failing = (exceed > allowed) | (stats.binom.cdf(allowed - exceed, remaining, p_exceed) < alpha)
+        passing = ~failing & (stats.binom.sf(allowed - exceed, remaining, p_exceed) < alpha)
+        if (passing | failing).all():
+            if failing.any():
+                return bins[failing].max(), drawn
+            return np.nextafter(bins.min(), -np.inf), drawn
+    
+    return np.partition(max_psd, rank)[rank], permute_cnt
+
+### add n to counter[name] when a counter dict is given
+def add_count(counter, name, n=1):
+    if counter is not None:
+        counter[name] = counter.get(name, 0) + n
+
+### add every count of other into counter (e.g. the counters returned by the workers)
+def merge_counts(counter, other):
+    if counter is not None:
+        for name, n in other.items():
+            add_count(counter, name, n)
+
+### shared do-nothing context of stage_timer without a counter
+_NO_TIMER = contextlib.nullcontext()
+
+class _StageTimer:
+    __slots__ = ('counter', 'name', 'start')
+
+    def __init__(self, counter, name):
+        self.counter = counter
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        add_count(self.counter, self.name, time.perf_counter() - self.start)
+
+### accumulate the wall time of the enclosed block in counter['time.<stage>'] (seconds)
+### without a counter the shared nullcontext is returned, so disabled instrumentation costs nothing
+def stage_timer(counter, stage):
+    if counter is None:
+        return _NO_TIMER
+    return _StageTimer(counter, 'time.' + stage)
+
+### ratio of the periodogram peak to its mean (DC bin excluded)
+def psd_peak_ratio(psd):
+    psd = np.asarray(psd)[1:]
+    return np.max(psd) / np.mean(psd)
+
 ### filter the freq using psd_threshold
 ### then convert freq to periods
 def get_potential_periods(freq, psd, psd_threshold):
@@ -17,6 +233,8 @@ def get_potential_periods(freq, psd, psd_threshold):
 
 ### get time intervals between connections
 def get_ts_intervals(data):
+    if isinstance(data, (SparseSignal, SpectralWorkspace)):
+        return data.ts_intervals
     data_idx = np.arange(len(data))
     data = np.array(data)
     ts_intervals = np.diff(data_idx[data>0])
@@ -28,6 +246,22 @@ def get_min_tsinterval(ts_intervals):
         return min(ts_intervals)
     return 0
 
+### minimum time interval of every row of a 2-D signal matrix (0 if the row has < 2 connections)
+def get_min_tsinterval_batch(data):
+    data = np.asarray(data)
+    rows, cols = np.nonzero(data > 0)
+    same_row = rows[1:] == rows[:-1]
+    min_ts = np.full(data.shape[0], np.inf)
+    np.minimum.at(min_ts, rows[1:][same_row], np.diff(cols)[same_row])
+    min_ts[np.isinf(min_ts)] = 0
+    return min_ts
+
+### time intervals of every row of a 2-D signal matrix, flattened in row order, and the row of every interval
+def get_ts_intervals_batch(data):
+    rows, cols = np.nonzero(np.asarray(data) > 0)
+    same_row = rows[1:] == rows[:-1]
+    return np.diff(cols)[same_row], rows[1:][same_row]
+
 ### filter potential periods
 def high_freq_pruning(potential_periods, min_tsintveral):
     return potential_periods[potential_periods>=min_tsintveral]
@@ -39,9 +273,25 @@ def autocorr(x):
     result[0] = 0
     return result
 
+### ACF of every row of a 2-D signal matrix through a zero-padded FFT instead of np.correlate
+### rows of integer counts are rounded back to the exact integer ACF so tied peaks stay tied
+def autocorr_batch(data, dtype=float):
+    data = np.asarray(data, dtype=dtype)
+    n = data.shape[-1]
+    nfft = fft.next_fast_len(2 * n - 1, True)
+    spec = fft.rfft(data, nfft, axis=-1)
+    result = fft.irfft(spec.real ** 2 + spec.imag ** 2, nfft, axis=-1)[..., :n]
+    is_count = (data == np.round(data)).all(axis=-1)
+    result[is_count] = np.round(result[is_count])
+    result[..., 0] = 0
+    return result
+
 ### get the peaks of autocorr
 def get_autocorr_peaks(data):
-    autocor_ts = autocorr(data)
+    return get_acf_peaks(autocorr(data))
+
+### get the peaks of a precomputed autocorr
+def get_acf_peaks(autocor_ts):
     autocor_ts_norm = autocor_ts / max(autocor_ts)
     peaks, _ = signal.find_peaks(autocor_ts_norm, prominence=0.2)
     return peaks
@@ -59,3 +309,222 @@ def acf_filtered_periodicity(potential_periods, autocorr_peaks, threshold=1):
         if min(abs(autocorr_peaks - period)) <= threshold:
             true_period.append(period)
     return true_period
+
+### acf_filtered_periodicity of many signals at once: lists of potential periods and ACF peaks, one per signal
+def acf_filtered_periodicity_batch(potential_periods, autocorr_peaks, threshold=1):
+    if len(potential_periods) == 0:
+        return []
+    pers = np.full((len(potential_periods), max(len(p) for p in potential_periods) or 1), np.nan)
+    peaks = np.full((len(autocorr_peaks), max(len(p) for p in autocorr_peaks) or 1), np.inf)
+    for i, (p, q) in enumerate(zip(potential_periods, autocorr_peaks)):
+        pers[i, :len(p)] = p
+        peaks[i, :len(q)] = q
+    keep = np.abs(pers[:, :, None] - peaks[:, None, :]).min(axis=2) <= threshold
+    return [list(np.asarray(p)[k[:len(p)]]) for p, k in zip(potential_periods, keep)]
+
+
+class SparseSignal:
+    """
+    sparse event-list representation of a count signal: the non-zero minutes and their counts
+    
+    connection counts, intervals and the sigcnt gate cost O(k) for k events instead of O(n),
+    the rfft and the ACF are direct sums over the events (O(k) per frequency / O(k^2) pairs)
+    
+    Parameters:
+        indices (array): sorted positions of the non-zero entries
+        counts (array): values at those positions
+        length (int): length of the dense signal
+    """
+    # above this many events the dense FFT path is cheaper than the direct sums
+    direct_max_events = 16
+
+    def __init__(self, indices, counts, length):
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.counts = np.asarray(counts, dtype=float)
+        self.length = int(length)
+
+    @classmethod
+    def from_dense(cls, data):
+        data = np.asarray(data)
+        indices = np.flatnonzero(data)
+        return cls(indices, data[indices], len(data))
+
+    ### build from raw event positions (e.g. minute of every connection), repeated positions are summed
+    @classmethod
+    def from_events(cls, events, length):
+        indices, counts = np.unique(np.asarray(events, dtype=np.int64), return_counts=True)
+        return cls(indices, counts, length)
+
+    def to_dense(self):
+        data = np.zeros(self.length)
+        data[self.indices] = self.counts
+        return data
+
+    def __len__(self):
+        return self.length
+
+    @property
+    def nnz(self):
+        return len(self.indices)
+
+    @property
+    def sigcnt(self):
+        return int(np.count_nonzero(self.counts > 0))
+
+    @property
+    def ts_intervals(self):
+        return np.diff(self.indices[self.counts > 0])
+
+    ### n-point rfft as a direct sum over the events
+    def rfft(self):
+        k = np.arange(self.length // 2 + 1)
+        phase = np.outer(k, self.indices) % self.length
+        return np.exp(-2j * np.pi * phase / self.length) @ self.counts
+
+    ### same as autocorr: sum of count products over every pair of events at each lag
+    def acf(self):
+        result = np.zeros(self.length)
+        i, j = np.triu_indices(self.nnz, 1)
+        np.add.at(result, self.indices[j] - self.indices[i], self.counts[i] * self.counts[j])
+        return result
+
+
+class SpectralWorkspace:
+    """
+    per-signal spectral workspace: one zero-padded rFFT shared by the rfft magnitude and the ACF
+    
+    the signal is zero padded to 2n points, so the even bins of its rFFT are the n-point rFFT,
+    and the inverse FFT of its power spectrum is the linear autocorrelation (Wiener-Khinchin).
+    detectors that never need the ACF (e.g. upnsca) only pay for the plain n-point rFFT.
+    the periodogram is compute_psd of the signal, bit-identical to the one the permutation test compares it with.
+    every derived quantity is computed on first access and cached, so several detectors can share one workspace.
+    
+    a SparseSignal input with few events is served by direct sums over its events and only densified
+    when the dense signal itself is needed.
+    
+    Parameters:
+        data (array or SparseSignal): input time series
+        sample_freq (float): sampling frequency of the periodogram
+        dtype: precision of the spectral quantities, np.float32 halves the FFT memory traffic
+    """
+    def __init__(self, data, sample_freq=1, dtype=float):
+        self.sample_freq = sample_freq
+        self.dtype = np.dtype(dtype)
+        self.sparse = None
+        if isinstance(data, SparseSignal):
+            self.sparse = data
+            self.n = data.length
+        else:
+            self.data = np.asarray(data, dtype=float)
+            self.n = len(self.data)
+
+    ### dense signal, only materialized on access for sparse inputs
+    @cached_property
+    def data(self):
+        return self.sparse.to_dense()
+
+    ### True if the direct sums over the sparse events are cheaper than the FFT
+    @property
+    def use_direct(self):
+        return self.sparse is not None and self.sparse.nnz <= self.sparse.direct_max_events
+
+    ### rFFT of the 2n-point zero padded signal
+    @cached_property
+    def spectrum(self):
+        return fft.rfft(self.data.astype(self.dtype, copy=False), 2 * self.n)
+
+    ### n-point rFFT of the signal, taken from the zero padded spectrum if the ACF already computed it
+    @cached_property
+    def rfft(self):
+        if self.use_direct:
+            return self.sparse.rfft().astype(np.result_type(self.dtype, np.complex64), copy=False)
+        if 'spectrum' in self.__dict__:
+            return self.spectrum[::2]
+        return fft.rfft(self.data.astype(self.dtype, copy=False))
+
+    @cached_property
+    def rfft_abs(self):
+        return np.abs(self.rfft)
+
+    ### compute_psd of the signal; sparse inputs served by direct sums (use_direct) take the rfft of the events with the
+    ### DC bin zeroed (the constant detrend only changes the DC bin), equal up to rounding, so a tied peak can flip
+    @cached_property
+    def psd(self):
+        if not self.use_direct:
+            return compute_psd(self.data, self.sample_freq, self.dtype)
+        spec = self.rfft.copy()
+        spec[0] = 0
+        return psd_from_rfft(spec, self.n, self.sample_freq)
+
+    ### same as autocorr, integer counts are rounded back to the exact integer ACF
+    @cached_property
+    def acf(self):
+        if self.use_direct:
+            return self.sparse.acf().astype(self.dtype, copy=False)
+        spec = self.spectrum
+        result = fft.irfft(spec.real ** 2 + spec.imag ** 2, 2 * self.n)[:self.n]
+        if (self.data == np.round(self.data)).all():
+            result = np.round(result)
+        result[0] = 0
+        return result
+
+    @cached_property
+    def acf_peaks(self):
+        return get_acf_peaks(self.acf)
+
+    @cached_property
+    def sigcnt(self):
+        if self.sparse is not None:
+            return self.sparse.sigcnt
+        return int(np.count_nonzero(self.data > 0))
+
+    @cached_property
+    def ts_intervals(self):
+        return get_ts_intervals(self.sparse if self.sparse is not None else self.data)
+
+    @cached_property
+    def min_tsinterval(self):
+        return get_min_tsinterval(self.ts_intervals)
+
+
+### wrap a signal into a SpectralWorkspace, existing workspaces are reused
+def as_workspace(data, sample_freq=1, dtype=float):
+    if isinstance(data, SpectralWorkspace):
+        return data
+    return SpectralWorkspace(data, sample_freq, dtype)
+
+
+### run method on every signal of df["tdf"]
+### with a seed, every signal gets its own rng derived from the seed and df[key_col] (or the signal content)
+def apply_method(df, method, seed=None, key_col=None, **kwargs):
+    if seed is None:
+        return list(df["tdf"].apply(method, **kwargs))
+    keys = df[key_col] if key_col is not None else df["tdf"]
+    return [method(sig, rng=signal_rng(seed, key), **kwargs) for sig, key in zip(df["tdf"], keys)]
+
+### content digest of a dense or sparse signal
+def signal_digest(sig):
+    if isinstance(sig, SparseSignal):
+        digest = hashlib.sha1(np.asarray(sig.indices, dtype=np.int64).tobytes())
+        digest.update(np.asarray(sig.counts, dtype=float).tobytes())
+        digest.update(repr(sig.length).encode())
+        return digest.hexdigest()
+    return hashlib.sha1(np.ascontiguousarray(sig, dtype=float).tobytes()).hexdigest()
+
+### run(df) once per distinct signal (and df[key_col] value, which changes the seeded rng) and
+### scatter the result columns back to the duplicate rows, df.attrs['dedup'] reports the dedup ratio
+def dedup_run(df, run, columns, key_col=None):
+    keys = [signal_digest(sig) for sig in df["tdf"]]
+    if key_col is not None:
+        keys = list(zip(keys, df[key_col]))
+    first = {}
+    row_first = np.array([first.setdefault(key, i) for i, key in enumerate(keys)], dtype=np.intp)
+    unique_idx = np.array(sorted(first.values()), dtype=np.intp)
+
+    resdf = run(df.iloc[unique_idx].copy())
+    pos = np.searchsorted(unique_idx, row_first)
+    for col in columns:
+        values = list(resdf[col])
+        df[col] = [values[p] for p in pos]
+    df.attrs['dedup'] = {'rows': len(df), 'unique': len(unique_idx), 'ratio': len(df) / max(len(unique_idx), 1)}
+    return df
@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+from functools import partial
+
+from .helpfns import as_workspace, signal_rng
+from .statsbased import stats_method
+from .upnsca import upnsca_method
+from .baywatch import baywatch_method
+from .bcndetection import bcndetection_method
+from .robustper import robustper_method
+from .runner import run_parallel
+from .signalstore import SignalStore
+
+
+### detectors of the multi-method runner, name -> method
+METHODS = {
+    'stats': stats_method,
+    'upnsca': upnsca_method,
+    'baywatch': baywatch_method,
+    'bcndetection': bcndetection_method,
+    'robustper': robustper_method,
+}
+
+### methods compared by the demo notebooks, robustper is left out as it is extremely slow
+DEFAULT_METHODS = ('stats', 'upnsca', 'baywatch', 'bcndetection')
+
+
+### '<method>_periods' and '<method>_detected' columns of the wide result frame
+def result_columns(methods=DEFAULT_METHODS):
+    return ['{}_{}'.format(name, col) for name in methods for col in ('periods', 'detected')]
+
+
+def multi_method(sig, methods=DEFAULT_METHODS, method_kwargs=None, seed=None, key=None):
+    """
+    run several detectors on one signal through a single SpectralWorkspace
+
+    sigcnt, the time intervals, the raw periodogram, the rfft magnitude and the ACF peaks are computed once on
+    first use and shared by every method. With a seed each method gets a fresh signal_rng(seed, key), the same
+    stream it gets when its own wrap runs with that seed, so the results match the single-method wraps.
+
+    Parameters:
+        sig (array, SparseSignal or SpectralWorkspace): input time series
+        methods (list): names of METHODS to run
+        method_kwargs (dict): optional method name -> kwargs of that method
+        seed (int): run seed
+        key: rng key of the signal (e.g. the pair key), the signal content if None
+    Returns:
+    list: periods and detected flag of every method, in the order of result_columns(methods)
+    """
+    ws = as_workspace(sig)
+    key = sig if key is None else key
+    method_kwargs = method_kwargs or {}
+    res = []
+    for name in methods:
+        kwargs = dict(method_kwargs.get(name, {}))
+        if seed is not None:
+            kwargs['rng'] = signal_rng(seed, key)
+        periods, detected = METHODS[name](ws, **kwargs)
+        res.extend([periods, detected])
+    return res
+
+
+def multi_method_wrap(df, methods=DEFAULT_METHODS, method_kwargs=None, seed=None, key_col=None):
+    """
+    wrap for data frame processing, adds one periods and one detected column per method (see result_columns)
+    """
+    columns = result_columns(methods)
+    if isinstance(df, SignalStore):
+        return df.run(partial(multi_method_wrap, methods=methods, method_kwargs=method_kwargs, seed=seed, key_col=key_col), columns)
+    keys = df[key_col] if key_col is not None else [None] * len(df)
+    res = [multi_method(sig, methods, method_kwargs, seed, key) for sig, key in zip(df["tdf"], keys)]
+    for j, col in enumerate(columns):
+        df[col] = [r[j] for r in res]
+    return df
+
+def mltproc_multi_method_wrap(df, maxproc = 16, chunksize=None, methods=DEFAULT_METHODS, **kwargs):
+    """
+    wrap func for multiprocessing
+    """
+    if isinstance(df, SignalStore):
+        return df.run(partial(mltproc_multi_method_wrap, maxproc=maxproc, chunksize=chunksize, methods=methods, **kwargs),
+                      result_columns(methods))
+    return run_parallel(df, multi_method_wrap, result_columns(methods), maxproc, chunksize, methods=methods, **kwargs)
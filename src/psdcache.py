@@ -0,0 +1,125 @@
+import os
+import uuid
+import pickle
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+from .helpfns import signal_rng
+
+
+class PSDThresholdCache:
+    """
+    LRU cache of permutation PSD thresholds.
+
+    The distribution of the maximum periodogram value over random permutations only
+    depends on the multiset of values in the signal, not on their order. Signals with
+    the same length and value histogram therefore share the same threshold and can
+    skip the permutation loop.
+
+    The permutations of a missing threshold are drawn from key_rng(key), a generator derived from
+    the seed and the key, so a cached threshold does not depend on which signal missed first.
+
+    In the mltproc_* wraps every worker keeps its own copy of the cache (loaded from path if set)
+    and sends the thresholds it computed back with the results, they are merged into this cache.
+
+    Parameters:
+        maxsize (int): maximum number of cached thresholds, least recently used are evicted first
+        path (str): optional pickle file, loaded on init if it exists and written by save()
+        seed (int): seed of the permutations drawn for the cached thresholds
+    """
+
+    def __init__(self, maxsize=100000, path=None, seed=0):
+        self.maxsize = maxsize
+        self.path = path
+        self.seed = seed
+        self.hits = 0
+        self.misses = 0
+        self.token = uuid.uuid4().hex
+        self._store = OrderedDict()
+        self._new = None
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    ### key: (signal length, value histogram digest, permute_cnt, C, sample_freq), plus the dtype name if not float64
+    @staticmethod
+    def make_key(data, permute_cnt, C, sample_freq=1, dtype=float):
+        data = np.asarray(data, dtype=float)
+        values, counts = np.unique(data, return_counts=True)
+        digest = hashlib.sha1(values.tobytes())
+        digest.update(counts.astype(np.int64).tobytes())
+        key = (len(data), digest.hexdigest(), int(permute_cnt), float(C), float(sample_freq))
+        if np.dtype(dtype) != np.float64:
+            key += (np.dtype(dtype).name,)
+        return key
+
+    ### random generator of the permutations of a missing threshold, only depends on the seed and the key
+    def key_rng(self, key):
+        return signal_rng(self.seed, key)
+
+    def get(self, key):
+        if key not in self._store:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._store.move_to_end(key)
+        return self._store[key]
+
+    def put(self, key, threshold):
+        self._store[key] = threshold
+        self._store.move_to_end(key)
+        if self._new is not None:
+            self._new[key] = threshold
+        while len(self._store) > self.maxsize:
+            self._store.popitem(last=False)
+
+    def clear(self):
+        self._store.clear()
+        self.hits = 0
+        self.misses = 0
+        self.token = uuid.uuid4().hex
+
+    ### empty cache with the same settings and token, sent to the pool workers instead of the entries
+    def task_copy(self):
+        copy = PSDThresholdCache(self.maxsize, seed=self.seed)
+        copy.path = self.path
+        copy.token = self.token
+        return copy
+
+    ### start recording the thresholds put and the hits / misses of one task (worker side)
+    def track(self):
+        self._new = {}
+        self._tracked = (self.hits, self.misses)
+
+    ### (new entries, hits, misses) since track(), merged by the parent with update()
+    def drain(self):
+        entries, self._new = list(self._new.items()), None
+        return entries, self.hits - self._tracked[0], self.misses - self._tracked[1]
+
+    ### merge the entries and counts drained from a worker copy
+    def update(self, delta):
+        entries, hits, misses = delta
+        for key, threshold in entries:
+            self.put(key, threshold)
+        self.hits += hits
+        self.misses += misses
+
+    def save(self, path=None):
+        path = path or self.path
+        tmppath = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmppath, "wb") as f:
+            pickle.dump(list(self._store.items()), f)
+        os.replace(tmppath, path)
+
+    def load(self, path=None):
+        path = path or self.path
+        with open(path, "rb") as f:
+            for key, threshold in pickle.load(f):
+                self.put(key, threshold)
+
+    def __len__(self):
+        return len(self._store)
+
+    def __contains__(self, key):
+        return key in self._store
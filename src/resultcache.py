@@ -0,0 +1,161 @@
+import time
+import pickle
+import sqlite3
+import hashlib
+
+import numpy as np
+
+from .helpfns import SparseSignal
+
+
+### kwargs of the wraps that do not change the detection results, left out of the cache key
+### (a PSDThresholdCache does: its missing thresholds are drawn from its seed, make_key adds that seed instead)
+### cascade selects the method name of the key, table_dir only moves the Fisher tables
+IGNORED_PARAMS = ('batch', 'batched', 'cache', 'counter', 'result_cache', 'shared', 'max_periods',
+                  'maxproc', 'chunksize', 'mute', 'cascade', 'table_dir')
+
+
+class ResultCache:
+    """
+    persistent, content-addressed cache of detection results in a local SQLite file
+
+    Results are keyed by a hash of the signal bytes, the method name and the method parameters, so
+    byte-identical signals (the same update check on many machines, the same pair day over day) are
+    only processed once. The cache is bounded to maxsize entries, least recently used entries are
+    evicted first, and entries older than ttl seconds are treated as misses.
+
+    Parameters:
+        path (str): SQLite database file
+        maxsize (int): maximum number of cached results
+        ttl (float): optional time to live of an entry in seconds
+    """
+
+    def __init__(self, path, maxsize=1000000, ttl=None):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path)
+            self._conn.execute("CREATE TABLE IF NOT EXISTS results "
+                               "(key TEXT PRIMARY KEY, value BLOB, created REAL, accessed REAL)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)")
+        return self._conn
+
+    ### key: sha256 of the float64 signal bytes, the method name, the parameters and the optional pair key
+    ### a PSDThresholdCache in use enters the key as ('psd_cache_seed', its seed)
+    @staticmethod
+    def make_key(signal, method_name, params, pair_key=None):
+        if isinstance(signal, SparseSignal):
+            signal = signal.to_dense()
+        signal = np.ascontiguousarray(signal, dtype=float)
+        digest = hashlib.sha256(signal.tobytes())
+        psd_cache = params.get('cache')
+        params = [(k, v) for k, v in params.items() if k not in IGNORED_PARAMS]
+        if psd_cache is not None:
+            params.append(('psd_cache_seed', psd_cache.seed))
+        params = sorted(params)
+        digest.update(repr((len(signal), method_name, params, pair_key)).encode())
+        return digest.hexdigest()
+
+    def get_many(self, keys):
+        """
+        Returns:
+        dict: key -> cached value of the keys found in the cache
+        """
+        now = time.time()
+        found = {}
+        unique_keys = list(set(keys))
+        for i in range(0, len(unique_keys), 500):
+            chunk = unique_keys[i:i + 500]
+            rows = self.conn.execute("SELECT key, value, created FROM results WHERE key IN ({})".format(
+                ",".join("?" * len(chunk))), chunk).fetchall()
+            for key, value, created in rows:
+                if self.ttl is None or now - created <= self.ttl:
+                    found[key] = pickle.loads(value)
+        with self.conn:
+            self.conn.executemany("UPDATE results SET accessed = ? WHERE key = ?", [(now, k) for k in found])
+        self.hits += sum(1 for k in keys if k in found)
+        self.misses += sum(1 for k in keys if k not in found)
+        return found
+
+    def put_many(self, items):
+        now = time.time()
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                                  [(k, pickle.dumps(v), now, now) for k, v in items])
+        self.evict()
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def put(self, key, value):
+        self.put_many([(key, value)])
+
+    ### drop expired entries and the least recently used entries beyond maxsize
+    def evict(self):
+        with self.conn:
+            if self.ttl is not None:
+                self.conn.execute("DELETE FROM results WHERE created < ?", (time.time() - self.ttl,))
+            excess = len(self) - self.maxsize
+            if excess > 0:
+                self.conn.execute("DELETE FROM results WHERE key IN "
+                                  "(SELECT key FROM results ORDER BY accessed LIMIT ?)", (excess,))
+
+    def clear(self):
+        with self.conn:
+            self.conn.execute("DELETE FROM results")
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self)}
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_conn'] = None
+        return state
+
+
+def cached_run(df, run, method_name, columns, result_cache, params):
+    """
+    run a wrap through a ResultCache: results of cached signals are filled in from the cache,
+    only the remaining rows are passed to run and their results are stored
+
+    Parameters:
+        df (DataFrame): frame with the "tdf" signal column
+        run (function): wrap that fills `columns` of a sub frame
+        method_name (str): name of the detector in the cache key
+        columns (list): result columns of the wrap
+        result_cache (ResultCache): the cache
+        params (dict): method parameters of the cache key
+    """
+    key_col = params.get('key_col')
+    pair_keys = df[key_col] if key_col is not None else [None] * len(df)
+    keys = [result_cache.make_key(sig, method_name, params, pair_key) for sig, pair_key in zip(df["tdf"], pair_keys)]
+    found = result_cache.get_many(keys)
+
+    miss = np.array([key not in found for key in keys], dtype=bool)
+    if miss.any():
+        resdf = run(df[miss].copy())
+        values = list(zip(*[resdf[col] for col in columns]))
+        new_items = dict(zip([key for key, m in zip(keys, miss) if m], values))
+        result_cache.put_many(new_items.items())
+        found.update(new_items)
+
+    for j, col in enumerate(columns):
+        df[col] = [found[key][j] for key in keys]
+    return df
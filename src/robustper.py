@@ -4,14 +4,24 @@ import scipy
 import multiprocessing
 
 from .robustperiod import robust_period_full
+from .robustperiod.fisher import TABLE_DIR
+from .helpfns import SparseSignal, SpectralWorkspace, apply_method, add_count
+from .runner import run_parallel, dispatch_wrap
 
 
-def robustper_method(x):
+def robustper_method(x, rng=None, counter=None, mperio='rlm', top_k=10, fisher='author', table_dir=TABLE_DIR):
     """"
     wrap the unofficial implementation of RobustPeriod: Time-Frequency Mining for Robust Multiple Periodicities Detection
     https://github.com/ariaghora/robust-period
     
     Warning: extremely slow
+    rng is accepted for a uniform detector interface, the method is deterministic
+    counter (dict) collects 'signals', 'detected', 'exit.<stage>' and the robust_period_full stage timings
+    mperio='irls' computes the M-periodograms with the vectorized Huber IRLS instead of one statsmodels RLM per frequency
+    mperio='approx' fits the Huber coefficients only around the top_k classical periodogram peaks,
+    the detected periods can differ from the full mode (benchmarks/mperio_accuracy.py)
+    fisher='table' looks the Fisher g-test p-values up in a precomputed table (see fisher_table)
+    persisted in table_dir, None keeps the tables in memory only
     
     Returns: 
     array: list of detected periods (empty if the method does not report specific detected periods)
@@ -25,34 +35,48 @@ def robustper_method(x):
     detected = False
     periods = []
     
-    sigcnt = len(x[x>0])
+    if isinstance(x, (SparseSignal, SpectralWorkspace)):
+        sigcnt = x.sigcnt
+    else:
+        sigcnt = len(x[x>0])
     
+    add_count(counter, 'signals')
     if sigcnt < 3:
+        add_count(counter, 'exit.sigcnt')
         return periods, detected
     
-    periods = robust_period_full(x, 'db10', num_wavelets, lmb, c, zeta)[0]
+    if isinstance(x, SparseSignal):
+        x = x.to_dense()
+    elif isinstance(x, SpectralWorkspace):
+        x = x.data
+    
+    periods = robust_period_full(x, 'db10', num_wavelets, lmb, c, zeta, counter=counter, mperio=mperio, top_k=top_k, fisher=fisher, table_dir=table_dir)[0]
     
     if len(periods) > 0:
         detected = True
+        add_count(counter, 'detected')
+    else:
+        add_count(counter, 'exit.no_period')
     
     return periods, detected
     
-def robustper_wrap(df):
+def robustper_wrap(df, result_cache=None, dedup=False, **kwargs):
     """
     wrap for data frame processing
     """
-    df['periods'], df['detected'] = zip(*df["tdf"].apply(robustper_method))
+    resdf = dispatch_wrap(df, robustper_wrap, 'robustper_method', ['periods', 'detected'], result_cache, dedup, **kwargs)
+    if resdf is not None:
+        return resdf
+    df['periods'], df['detected'] = zip(*apply_method(df, robustper_method, **kwargs))
     return df
 
 
-def mltproc_robustper_wrap(df, maxproc = 16, mute = False):
+def mltproc_robustper_wrap(df, maxproc = 16, mute = False, result_cache=None, dedup=False, chunksize=None, **kwargs):
     """
     wrap func for multiprocessing
     """    
-    pool = multiprocessing.Pool(processes = maxproc)
-
-    df_lst = np.array_split(df, maxproc)
-    res = pool.map(robustper_wrap, df_lst)
-
-    resdf = pd.concat(res)
-    return resdf
+    resdf = dispatch_wrap(df, mltproc_robustper_wrap, 'robustper_method', ['periods', 'detected'], result_cache, dedup,
+                          maxproc=maxproc, chunksize=chunksize, mute=mute, **kwargs)
+    if resdf is not None:
+        return resdf
+    return run_parallel(df, robustper_wrap, ['periods', 'detected'], maxproc, chunksize, **kwargs)
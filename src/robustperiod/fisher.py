@@ -1,5 +1,20 @@
+import os
+import math
 import numpy as np
 import scipy
+from functools import lru_cache
+from scipy.special import gammaln
+
+
+# directory of the persisted p-value tables, one .npy file per periodogram length
+TABLE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'robustperiod')
+
+# format version of the table files, bump it when log_p_val_g_stat changes
+TABLE_VERSION = 1
+
+# points of the dense and the coarse part of table_grid
+TABLE_DENSE = 32769
+TABLE_COARSE = 4097
 
 
 def choose(n, k):
@@ -52,9 +67,103 @@ def p_val_g_stat(g0, N, method='author'):
     return pval
 
 
-def fisher_g_test(per, method='author'):
-    ''' per: periodogram'''
+def log_p_val_g_stat(g0, N):
+    '''
+    numerically stable log p-value of the g statistic, log of the series of p_val_g_stat
+    The terms binom(N, k) (1 - k g0)^(N-1) are taken in log space and summed relative
+    to the largest one with math.fsum. Every log term carries a rounding error of about
+    eps * log N!, when the alternating series cancels so much that this error exceeds
+    exp(-lambda) the p-value is close to 1 and the Poisson approximation
+    1 - exp(-lambda), lambda = N (1 - g0)^(N-1), of the same inclusion-exclusion sum is used.
+    '''
+    if g0 <= 0:
+        return 0.
+    log_lambda = np.log(N) + (N - 1) * np.log1p(-min(g0, 1.))
+    if log_lambda > np.log(40):
+        # P(no exceedance) = exp(-lambda) is below double precision
+        return 0.
+    k = np.arange(1, min(int(np.floor(1 / g0)), N) + 1)
+    log_terms = (gammaln(N + 1) - gammaln(k + 1) - gammaln(N - k + 1)
+                 + (N - 1) * np.log(np.maximum(1 - k * g0, 0)))
+    top = log_terms.max()
+    if not np.isfinite(top):
+        return -np.inf
+    terms = np.exp(log_terms - top)
+    rel = math.fsum((-1.) ** (k - 1) * terms)
+    series_err = 4 * np.finfo(float).eps * gammaln(N + 1) * terms.sum() * np.exp(top)
+    if rel <= 0 or series_err > np.exp(-np.exp(log_lambda)):
+        return float(np.log(-np.expm1(-np.exp(log_lambda))))
+    return min(float(top + np.log(rel)), 0.)
+
+
+### g grid of the tables: dense where the p-value drops from 1 (g up to 64 / N), coarse above
+def table_grid(N, dense=TABLE_DENSE, coarse=TABLE_COARSE):
+    g_dense = min(1., 64. / N)
+    return np.unique(np.hstack([np.linspace(0, g_dense, dense), np.linspace(g_dense, 1., coarse)]))
+
+
+class FisherTable:
+    '''
+    p-value table of the Fisher g-test for periodograms of length N
+    log p-values of log_p_val_g_stat on table_grid(N), linearly interpolated in g.
+    With a path the table is loaded (memory-mapped, so the pages are shared by all
+    workers) if the file exists, else computed once and written atomically. If the
+    file cannot be read or written the table is kept in memory only (path is None).
+    '''
+    # floor of the tabulated log p-values, exp(LOG_P_MIN) is 0
+    LOG_P_MIN = -1e4
+
+    def __init__(self, N, path=None):
+        self.N = N
+        self.path = path
+        if path is not None and os.path.exists(path):
+            try:
+                self.grid, self.log_p = np.load(path, mmap_mode='r')
+                return
+            except (OSError, ValueError):
+                pass
+        self.grid = table_grid(N)
+        self.log_p = np.maximum([log_p_val_g_stat(g0, N) for g0 in self.grid], self.LOG_P_MIN)
+        if path is not None:
+            try:
+                self.save(path)
+            except OSError:
+                self.path = None
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp = '{}.{}.tmp.npy'.format(os.path.splitext(path)[0], os.getpid())
+        np.save(tmp, np.vstack([self.grid, self.log_p]))
+        os.replace(tmp, path)
+
+    def pvalue(self, g):
+        '''p-value of the g statistic (scalar or array)'''
+        return np.exp(np.interp(g, self.grid, self.log_p))
+
+    def critical_value(self, alpha=0.05):
+        '''smallest tabulated g whose p-value is at most alpha'''
+        return self.grid[np.argmax(np.asarray(self.log_p) <= np.log(alpha))]
+
+
+### file name of a table: length, grid and format version, so a changed grid or series never loads an old table
+def table_file(N):
+    return 'fisher_g_v{}_N{}_d{}_c{}.npy'.format(TABLE_VERSION, N, TABLE_DENSE, TABLE_COARSE)
+
+
+@lru_cache(maxsize=None)
+def fisher_table(N, table_dir=TABLE_DIR):
+    '''FisherTable of length N, persisted as <table_dir>/table_file(N), in memory only if table_dir is None'''
+    path = None if table_dir is None else os.path.join(table_dir, table_file(N))
+    return FisherTable(N, path)
+
+
+def fisher_g_test(per, method='author', table_dir=TABLE_DIR):
+    ''' per: periodogram
+    method='table' looks the p-value up in the fisher_table of len(per),
+    persisted in table_dir (None keeps the tables in memory only)'''
     g = max(per) / np.sum(per)
+    if method == 'table':
+        return float(fisher_table(len(per), table_dir).pvalue(g)), g
     pval = p_val_g_stat(g, len(per), method=method)
     return pval, g
 
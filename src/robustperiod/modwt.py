@@ -2,50 +2,61 @@
 
 import pywt
 import numpy as np
+from functools import lru_cache
+
+
+@lru_cache(maxsize=None)
+def wavelet_filters(filters):
+    '''
+    scaled MODWT filters of a pywt wavelet, cached per name
+    return: \tilde{h} = h / sqrt(2), \tilde{g} = g / sqrt(2)
+    '''
+    wavelet = pywt.Wavelet(filters)
+    h_t = np.array(wavelet.dec_hi) / np.sqrt(2)
+    g_t = np.array(wavelet.dec_lo) / np.sqrt(2)
+    h_t.flags.writeable = False
+    g_t.flags.writeable = False
+    return h_t, g_t
+
+
+@lru_cache(maxsize=64)
+def circular_indices(N, L, j):
+    '''
+    gather indices of the jth level circular convolution, index[t, l] = (t - 2^(j-1) l) mod N
+    only the first L_j = min(N, (2**4-1)*(L-1)) filter taps are kept (matching the paper)
+    '''
+    L_j = min(N, (2**4-1)*(L-1), L)
+    index = np.mod(np.arange(N)[:, None] - 2 ** (j - 1) * np.arange(L_j)[None, :], N)
+    index.flags.writeable = False
+    return index
 
 
 def circular_convolve_d(h_t, v_j_1, j):
     '''
     jth level decomposition
     h_t: \tilde{h} = h / sqrt(2)
-    v_j_1: v_{j-1}, the (j-1)th scale coefficients
+    v_j_1: v_{j-1}, the (j-1)th scale coefficients, one series per row for a batch
     return: w_j (or v_j)
     '''
-    N = len(v_j_1)
-    
-    L = len(h_t)
-
-    # Matching the paper
-    L_j = min(N, (2**4-1)*(L-1))
-
-    w_j = np.zeros(N)
-    l = np.arange(L)
-
-    for t in range(N):
-        index = np.mod(t - 2 ** (j - 1) * l, N)
-        v_p = np.array([v_j_1[ind] for ind in index])
-        # Keeping up to L_j items
-        w_j[t] = (np.array(h_t)[:L_j] * v_p[:L_j]).sum()
-    return w_j
+    v_j_1 = np.asarray(v_j_1, dtype=float)
+    index = circular_indices(v_j_1.shape[-1], len(h_t), j)
+    return v_j_1[..., index] @ np.asarray(h_t)[:index.shape[1]]
 
 
 def modwt(x, filters, level):
     '''
     filters: 'db1', 'db2', 'haar', ...
-    return: see matlab
+    x: a series, or a 2-D batch of equal-length series (one per row)
+    return: see matlab, level x N coefficients (batch x level x N for a batch)
     '''
     # filter
-    wavelet = pywt.Wavelet(filters)
-    h = wavelet.dec_hi
-    g = wavelet.dec_lo
-    h_t = np.array(h) / np.sqrt(2)
-    g_t = np.array(g) / np.sqrt(2)
+    h_t, g_t = wavelet_filters(filters)
     wavecoeff = []
-    v_j_1 = x
+    v_j_1 = np.asarray(x, dtype=float)
     for j in range(level):
         w = circular_convolve_d(h_t, v_j_1, j + 1)
         v_j_1 = circular_convolve_d(g_t, v_j_1, j + 1)
         # if j > 0:
         wavecoeff.append(w)
     # wavecoeff.append(v_j_1)
-    return np.vstack(wavecoeff)
\ No newline at end of file
+    return np.stack(wavecoeff, axis=-2)
@@ -0,0 +1,173 @@
+import numpy as np
+from scipy.stats import norm
+
+
+# normalization constant of statsmodels.robust.scale.mad
+GAUSSIAN_3_4 = norm.ppf(3 / 4.)
+
+
+def huber_rho(z, t):
+    absz = np.abs(z)
+    m = np.minimum(absz, t)
+    return m * (absz - 0.5 * m)
+
+
+def huber_weights(z, t):
+    return t / np.maximum(np.abs(z), t)
+
+
+def _rowdot(a, b):
+    return np.einsum('ij,ij->i', a, b)
+
+
+class _RegressorPairs:
+    '''
+    cosine / sine regressor pairs (C[k], S[k]) of one block of frequencies with their products,
+    so every weighted least squares step only takes row dot products with the weights
+    '''
+    def __init__(self, y, C, S):
+        self.y, self.C, self.S = y, C, S
+        self.CC, self.CS, self.SS = C * C, C * S, S * S
+        self.Cy, self.Sy = C * y, S * y
+        self.singular = (S == 0).all(axis=1)
+
+    def subset(self, idx):
+        sub = _RegressorPairs.__new__(_RegressorPairs)
+        sub.y = self.y
+        for name in ('C', 'S', 'CC', 'CS', 'SS', 'Cy', 'Sy', 'singular'):
+            setattr(sub, name, getattr(self, name)[idx])
+        return sub
+
+    def wls(self, w):
+        '''
+        weighted least squares of y on every regressor pair, closed form 2x2 normal equations
+        a pair with an all-zero sine (j = 0) is solved like np.linalg.pinv: b = 0
+        return: a, b and the residuals
+        '''
+        cc, cs, ss = _rowdot(w, self.CC), _rowdot(w, self.CS), _rowdot(w, self.SS)
+        cy, sy = _rowdot(w, self.Cy), _rowdot(w, self.Sy)
+        det = np.where(self.singular, 1., cc * ss - cs * cs)
+        a = np.where(self.singular, cy / cc, (ss * cy - cs * sy) / det)
+        b = np.where(self.singular, 0., (cc * sy - cs * cy) / det)
+        resid = self.y - a[:, None] * self.C - b[:, None] * self.S
+        return a, b, resid
+
+
+def huber_irls_pair(y, C, S, t=1.345, maxiter=50, tol=1e-8):
+    '''
+    Huber IRLS of y on every regressor pair (C[k], S[k]) at once, replicating
+    sm.RLM(y, [C[k], S[k]], M=HuberT(t)).fit(): OLS start, mad scale (center 0)
+    updated after every step, deviance convergence (change <= tol) and maxiter,
+    stop when the mad scale is 0. Converged pairs are masked out of the next steps.
+    - y: series of length n
+    - C, S: (k, n) cosine and sine regressors
+    return: (k, 2) coefficients
+    '''
+    n = len(y)
+    pairs = _RegressorPairs(y, C, S)
+    a, b, resid = pairs.wls(np.ones_like(C))
+    scale = np.median(np.abs(resid), axis=1) / GAUSSIAN_3_4
+    # the OLS start is a full WLS fit, its residual degrees of freedom use the rank of the regressors
+    df_resid = np.where(pairs.singular, n - 1, n - 2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        wls_scale = _rowdot(resid, resid) / df_resid
+        deviance = huber_rho(resid / wls_scale[:, None], t).sum(axis=1)
+
+    active = np.ones(len(C), dtype=bool)
+    pos = np.arange(len(C))
+    iteration = 1
+    while True:
+        active &= scale != 0.0
+        idx = np.flatnonzero(active)
+        if len(idx) == 0:
+            break
+        # drop the converged pairs from the precomputed products
+        if len(idx) < len(pos):
+            pairs, pos = pairs.subset(np.searchsorted(pos, idx)), idx
+        w = huber_weights(resid[idx] / scale[idx, None], t)
+        a_k, b_k, resid_k = pairs.wls(w)
+        a[idx], b[idx], resid[idx] = a_k, b_k, resid_k
+        scale[idx] = np.median(np.abs(resid_k), axis=1) / GAUSSIAN_3_4
+        with np.errstate(divide='ignore', invalid='ignore'):
+            wls_scale = _rowdot(w * resid_k, resid_k) / (n - 2)
+            dev_k = huber_rho(resid_k / wls_scale[:, None], t).sum(axis=1)
+        iteration += 1
+        converged = ~(np.abs(dev_k - deviance[idx]) > tol) | (iteration >= maxiter)
+        deviance[idx] = dev_k
+        active[idx[converged]] = False
+    return np.stack([a, b], axis=1)
+
+
+def m_perio_reg_irls(series, t=1.345, maxiter=50, tol=1e-8, block=64):
+    '''
+    M-periodogram of m_perio_reg with all Fourier frequencies fitted by one vectorized
+    Huber IRLS (huber_irls_pair) instead of one statsmodels RLM per frequency
+    - series: a series, or a 2-D batch of equal-length series (one per row, e.g. the wavelet levels)
+    - block: frequencies fitted together, bounds the (block, n) work arrays
+    return: the periodogram (one row per series for a batch)
+    '''
+    series = np.asarray(series, dtype=float)
+    batch = np.atleast_2d(series)
+    n = batch.shape[1]
+    g = n // 2
+    idx = np.arange(0, n)
+    perior = np.empty((len(batch), g))
+    for lo in range(0, g, block):
+        j = np.arange(lo, min(lo + block, g))
+        w = 2. * np.pi * j / n
+        C, S = np.cos(w[:, None] * idx), np.sin(w[:, None] * idx)
+        for row, y in enumerate(batch):
+            params = huber_irls_pair(y, C, S, t, maxiter, tol)
+            # |sqrt(n / (8 pi)) * complex(a, -b)| ** 2, j < n / 2 for every fitted frequency
+            perior[row, lo:lo + len(j)] = n / (8 * np.pi) * (params ** 2).sum(axis=1)
+    res = np.hstack([perior, np.flip(perior, axis=1)])
+    return res if series.ndim > 1 else res[0]
+
+
+def classical_perio(series):
+    '''
+    classical periodogram on the scale of m_perio_reg: the OLS (non robust) fit of
+    the Fourier frequency j gives |X_j|^2 / (2 pi n), and |X_0|^2 / (8 pi n) for j = 0
+    - series: a series, or a 2-D batch of equal-length series (one per row)
+    return: the first n // 2 values (one row per series for a batch)
+    '''
+    series = np.asarray(series, dtype=float)
+    n = series.shape[-1]
+    spec = np.fft.rfft(series, axis=-1)[..., :n // 2]
+    perior = (spec.real ** 2 + spec.imag ** 2) / (2 * np.pi * n)
+    perior[..., 0] /= 4
+    return perior
+
+
+def m_perio_reg_approx(series, top_k=10, neighbours=1, t=1.345, maxiter=50, tol=1e-8):
+    '''
+    approximate M-periodogram: the classical periodogram picks the top_k candidate
+    frequencies, the Huber coefficients are fitted only at the candidates and their
+    neighbours (+- neighbours bins), every other frequency keeps the classical value
+    scaled by the median robust / classical ratio of the fitted bins.
+    Not exact: a robust peak outside the candidates is missed, so the detected
+    periods can differ from the full mode (m_perio_reg_irls), see the README
+    benchmarks table of benchmarks/mperio_accuracy.py
+    - series: a series, or a 2-D batch of equal-length series (one per row)
+    - top_k: number of candidate frequencies, top_k >= n // 2 fits every frequency
+    return: the periodogram (one row per series for a batch), same layout as m_perio_reg
+    '''
+    series = np.asarray(series, dtype=float)
+    batch = np.atleast_2d(series)
+    n = batch.shape[1]
+    g = n // 2
+    idx = np.arange(0, n)
+    perior = classical_perio(batch)
+    for row, y in enumerate(batch):
+        top = np.argpartition(perior[row], -min(top_k, g))[-min(top_k, g):]
+        j = np.unique(np.clip(top[:, None] + np.arange(-neighbours, neighbours + 1), 0, g - 1))
+        w = 2. * np.pi * j / n
+        params = huber_irls_pair(y, np.cos(w[:, None] * idx), np.sin(w[:, None] * idx), t, maxiter, tol)
+        robust = n / (8 * np.pi) * (params ** 2).sum(axis=1)
+        # the Huber fit shrinks the power, bring the classical fill to the level of the fitted bins
+        fitted = perior[row, j] > 0
+        if fitted.any():
+            perior[row] *= np.median(robust[fitted] / perior[row, j][fitted])
+        perior[row, j] = robust
+    res = np.hstack([perior, np.flip(perior, axis=1)])
+    return res if series.ndim > 1 else res[0]
@@ -7,8 +7,10 @@ from scipy.signal import find_peaks
 from .modwt import modwt
 from .utils import sinewave, triangle
 from .mperioreg_fallback import m_perio_reg
+from .mperioreg_irls import m_perio_reg_irls, m_perio_reg_approx
 from .huberacf import huber_acf, get_ACF_period
-from .fisher import fisher_g_test
+from .fisher import fisher_g_test, TABLE_DIR
+from ..helpfns import add_count, stage_timer
 
 
 def extract_trend(y, reg):
@@ -34,7 +36,7 @@ def residual_autocov(x, c):
     return huber_func((x - mu)/s, c)
 
 
-def robust_period_full(x, wavelet_method, num_wavelet, lmb, c, zeta=1.345):
+def robust_period_full(x, wavelet_method, num_wavelet, lmb, c, zeta=1.345, counter=None, mperio='rlm', top_k=10, fisher='author', table_dir=TABLE_DIR):
     '''
     Params:
     - x: input signal with shape of (m, n), m is the number of observation and
@@ -44,6 +46,18 @@ def robust_period_full(x, wavelet_method, num_wavelet, lmb, c, zeta=1.345):
     - lmb: Lambda (regularization param) in Hodrick–Prescott (HP) filter
     - c: Huber function hyperparameter
     - zeta: M-Periodogram hyperparameter
+    - counter: optional instrumentation dict, accumulates the per-stage wall
+               time 'time.<stage>', the 'levels' processed and the 'candidates'
+    - mperio: M-periodogram engine, 'rlm' fits one statsmodels RLM per
+              frequency, 'irls' fits all frequencies of all levels with the
+              vectorized Huber IRLS of m_perio_reg_irls, 'approx' fits only the
+              top_k classical periodogram peaks and their neighbours
+              (m_perio_reg_approx), the detected periods can differ from
+              the full mode (see the README benchmarks table)
+    - top_k: number of candidate frequencies of the 'approx' mode
+    - fisher: p-value method of fisher_g_test, 'table' looks the p-values up
+              in the persisted fisher_table of the periodogram length
+    - table_dir: directory of the persisted tables, None keeps them in memory
 
     Returns:
     - Array of periods
@@ -61,51 +75,69 @@ def robust_period_full(x, wavelet_method, num_wavelet, lmb, c, zeta=1.345):
     # ----------------
     # Extract trend and then deterend input series. Then perform residual
     # autocorrelation to remove extreme outliers.
-    trend, y_hat = extract_trend(x, lmb)
-    y_prime = residual_autocov(y_hat, c)
+    with stage_timer(counter, 'detrend'):
+        trend, y_hat = extract_trend(x, lmb)
+        y_prime = residual_autocov(y_hat, c)
 
     # 2) Decoupling multiple periodicities
     # ------------------------------------
     # Perform MODWT and ranking by robust wavelet variance
-    W = modwt(y_prime, wavelet_method, level=num_wavelet)
+    with stage_timer(counter, 'modwt'):
+        W = modwt(y_prime, wavelet_method, level=num_wavelet)
 
     # compute wavelet variance for all levels
     # TODO Clarifying Lj, so we can omit first Lj from wj
-    bivar = np.array([biweight_midvariance(w) for w in W])
+    with stage_timer(counter, 'bivar'):
+        bivar = np.array([biweight_midvariance(w) for w in W])
+    add_count(counter, 'levels', len(W))
 
     # 3) Robust single periodicity detection
     # --------------------------------------
     # Compute Huber periodogram
     X = np.hstack([W, np.zeros_like(W)])
 
+    if mperio == 'irls':
+        with stage_timer(counter, 'mperiodogram'):
+            batch_perio = m_perio_reg_irls(X)
+    elif mperio == 'approx':
+        with stage_timer(counter, 'mperiodogram'):
+            batch_perio = m_perio_reg_approx(X, top_k)
+
     periodograms = []
     p_vals = []
     for i, x in enumerate(X):
         #print(f'Calculating periodogram for level {i+1}')
-        perio = m_perio_reg(x)
-        p_val, _ = fisher_g_test(perio)
+        if mperio in ('irls', 'approx'):
+            perio = batch_perio[i]
+        else:
+            with stage_timer(counter, 'mperiodogram'):
+                perio = m_perio_reg(x)
+        with stage_timer(counter, 'fisher'):
+            p_val, _ = fisher_g_test(perio, method=fisher, table_dir=table_dir)
         periodograms.append(perio)
         p_vals.append(p_val)
     periodograms = np.array(periodograms)
     # np.savetxt('periodograms.csv', periodograms, delimiter=',')
 
     # Compute Huber ACF
-    ACF = np.array([huber_acf(p) for p in periodograms])
-
-    periods = []
-    for acf in ACF:
-        peaks, _ = find_peaks(acf)
-        distances = np.diff(peaks)
-        final_period = np.median(distances)
-        periods.append(final_period)
-    periods = np.array(periods)
-
-    periods = []
-    for p in periodograms:
-        _, final_period, _ = get_ACF_period(p)
-        periods.append(final_period)
-    periods = np.array(periods)
+    with stage_timer(counter, 'huber_acf'):
+        ACF = np.array([huber_acf(p) for p in periodograms])
+
+        periods = []
+        for acf in ACF:
+            peaks, _ = find_peaks(acf)
+            distances = np.diff(peaks)
+            final_period = np.median(distances)
+            periods.append(final_period)
+        periods = np.array(periods)
+
+        periods = []
+        for p in periodograms:
+            _, final_period, _ = get_ACF_period(p)
+            periods.append(final_period)
+        periods = np.array(periods)
     final_periods = np.unique(periods[periods > 0])
+    add_count(counter, 'candidates', len(final_periods))
 
     return (
         final_periods,  # Periods
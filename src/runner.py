@@ -0,0 +1,283 @@
+import os
+import atexit
+import shutil
+import tempfile
+import multiprocessing
+from functools import partial
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from .helpfns import merge_counts, dedup_run
+from .resultcache import cached_run
+from .signalstore import SignalStore
+
+
+### shared worker pool of the mltproc_* wraps, created on first use and reused across calls
+_pool = None
+_pool_size = 0
+
+
+def get_pool(maxproc=16):
+    """
+    return the shared worker pool, (re)started if it does not exist yet or has another size
+    """
+    global _pool, _pool_size
+    if _pool is None or _pool_size != maxproc:
+        shutdown_pool()
+        _pool = multiprocessing.Pool(processes=maxproc)
+        _pool_size = maxproc
+    return _pool
+
+
+def shutdown_pool():
+    """
+    close and join the shared worker pool, registered with atexit
+    """
+    global _pool, _pool_size
+    if _pool is not None:
+        _pool.close()
+        _pool.join()
+        _pool = None
+        _pool_size = 0
+
+
+atexit.register(shutdown_pool)
+
+
+### default chunk size: about 8 chunks per worker so slow signals do not stall a whole share of the frame
+def default_chunksize(n, maxproc):
+    return int(max(1, min(64, np.ceil(n / (maxproc * 8)))))
+
+
+### a worker gets a fresh instrumentation counter per task, it is returned with the results and merged by the parent
+def _task_counter(kwargs):
+    if kwargs.get('counter') is None:
+        return None, kwargs
+    counter = {}
+    return counter, dict(kwargs, counter=counter)
+
+
+### worker side copies of the PSD threshold caches by token, they outlive a task so a worker reuses its thresholds
+_worker_caches = OrderedDict()
+_MAX_WORKER_CACHES = 4
+
+
+### the parent sends an empty copy of the PSDThresholdCache (cache.task_copy), the worker swaps in its own copy
+### (loaded from the cache file on first use) and returns the thresholds computed by the task, merged by the parent
+def _task_cache(kwargs):
+    cache = kwargs.get('cache')
+    if cache is None:
+        return None, kwargs
+    if cache.token not in _worker_caches:
+        if cache.path is not None and os.path.exists(cache.path):
+            cache.load()
+        _worker_caches[cache.token] = cache
+        while len(_worker_caches) > _MAX_WORKER_CACHES:
+            _worker_caches.popitem(last=False)
+    cache = _worker_caches[cache.token]
+    cache.track()
+    return cache, dict(kwargs, cache=cache)
+
+
+### parent side: kwargs of the tasks, with the cache replaced by its empty copy
+def _task_kwargs(kwargs):
+    if kwargs.get('cache') is None:
+        return kwargs
+    return dict(kwargs, cache=kwargs['cache'].task_copy())
+
+
+### merge what a task returned besides the results: the counter and the new cache entries
+def _merge_task(kwargs, counter, cache_delta):
+    merge_counts(kwargs.get('counter'), counter or {})
+    if cache_delta is not None:
+        kwargs['cache'].update(cache_delta)
+
+
+### worker side: rebuild a minimal frame from the signals (and pair keys) and return only the result columns
+def _run_chunk(task):
+    wrap, columns, signals, key_col, keys, kwargs = task
+    counter, kwargs = _task_counter(kwargs)
+    cache, kwargs = _task_cache(kwargs)
+    df = pd.DataFrame({"tdf": pd.Series(signals, dtype=object)})
+    if key_col is not None:
+        df[key_col] = keys
+    resdf = wrap(df, **kwargs)
+    return [list(resdf[col]) for col in columns], counter, cache.drain() if cache is not None else None
+
+
+def dispatch_wrap(df, wrap, method_name, columns, result_cache=None, dedup=False, **kwargs):
+    """
+    shared front of the *_wrap and mltproc_*_wrap functions: a SignalStore is run chunk by chunk, dedup=True runs
+    every distinct signal once (see dedup_run) and a ResultCache fills in the cached results (see cached_run).
+    Every step calls wrap again on what is left with the remaining options.
+
+    Parameters:
+        df (DataFrame or SignalStore): input of the wrap
+        wrap (function): the calling wrap
+        method_name (str): name of the detector in the result cache key
+        columns (list): result columns of the wrap
+        result_cache (ResultCache): optional result cache
+        dedup (bool): run every distinct signal once
+        **kwargs: the other arguments of the wrap
+    Returns:
+    DataFrame: the filled in frame, None if no step applies and the wrap processes df itself
+    """
+    if isinstance(df, SignalStore):
+        return df.run(partial(wrap, result_cache=result_cache, dedup=dedup, **kwargs), columns)
+    if dedup:
+        return dedup_run(df, partial(wrap, result_cache=result_cache, **kwargs), columns, kwargs.get('key_col'))
+    if result_cache is not None:
+        return cached_run(df, partial(wrap, **kwargs), method_name, columns, result_cache, kwargs)
+    return None
+
+
+def run_parallel(df, wrap, columns, maxproc=16, chunksize=None, shared=False, max_periods=16, **kwargs):
+    """
+    run a wrap over df on the shared pool
+
+    The frame is cut into small chunks that are handed to idle workers as they finish (dynamic scheduling).
+    Only the signals, the optional key_col values and the result columns cross the process boundary.
+
+    Parameters:
+        df (DataFrame): frame with the "tdf" signal column
+        wrap (function): single-process wrap, e.g. bcndetection_wrap
+        columns (list): result columns of the wrap
+        maxproc (int): number of worker processes
+        chunksize (int): signals per task, default_chunksize if None
+        shared (bool): transport the signals and results through shared memory (see run_shared)
+        max_periods (int): periods per signal that fit in the shared output buffer
+        **kwargs: passed to wrap, a counter dict receives the merged counts of all workers and a PSDThresholdCache
+            the thresholds computed by the workers
+    Returns:
+    DataFrame: df with the result columns filled in
+    """
+    n = len(df)
+    if n == 0:
+        for col in columns:
+            df[col] = []
+        return df
+    chunksize = chunksize or default_chunksize(n, maxproc)
+    if shared and {'periods', 'detected'} <= set(columns) and signal_matrix_shape(df["tdf"]) is not None:
+        return run_shared(df, wrap, columns, maxproc, chunksize, max_periods, **kwargs)
+    key_col = kwargs.get('key_col')
+    signals = list(df["tdf"])
+    keys = list(df[key_col]) if key_col is not None else None
+
+    task_kwargs = _task_kwargs(kwargs)
+    tasks = ((wrap, columns, signals[i:i + chunksize], key_col,
+              keys[i:i + chunksize] if keys is not None else None, task_kwargs)
+             for i in range(0, n, chunksize))
+    values = [[] for _ in columns]
+    for res, counter, cache_delta in get_pool(maxproc).imap(_run_chunk, tasks):
+        for j, col_values in enumerate(res):
+            values[j].extend(col_values)
+        _merge_task(kwargs, counter, cache_delta)
+
+    for col, col_values in zip(columns, values):
+        df[col] = col_values
+    return df
+
+
+### (rows, length, dtype) if the signals are dense arrays of equal length, else None
+def signal_matrix_shape(signals):
+    signals = list(signals)
+    if not all(isinstance(sig, np.ndarray) and sig.ndim == 1 for sig in signals):
+        return None
+    if len({len(sig) for sig in signals}) != 1:
+        return None
+    return len(signals), len(signals[0]), np.result_type(*signals)
+
+
+### directory for the shared buffers, /dev/shm keeps them in memory where it exists
+def _shared_dir():
+    return tempfile.mkdtemp(prefix="bcn_", dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+
+
+### worker side of run_shared: rows [lo, hi) are read from and the results written to the shared buffers
+### results that do not fit the buffers (more than max_periods periods, other columns) are returned
+def _run_shared_chunk(task):
+    wrap, columns, path, lo, hi, key_col, keys, kwargs = task
+    counter, kwargs = _task_counter(kwargs)
+    cache, kwargs = _task_cache(kwargs)
+    signals = np.load(os.path.join(path, "signals.npy"), mmap_mode="r")
+    df = pd.DataFrame({"tdf": pd.Series(list(signals[lo:hi]), dtype=object)})
+    if key_col is not None:
+        df[key_col] = keys
+    resdf = wrap(df, **kwargs)
+
+    periods = np.load(os.path.join(path, "periods.npy"), mmap_mode="r+")
+    period_cnt = np.load(os.path.join(path, "period_cnt.npy"), mmap_mode="r+")
+    detected = np.load(os.path.join(path, "detected.npy"), mmap_mode="r+")
+    extra = {}
+    for i, (pers, det) in enumerate(zip(resdf["periods"], resdf["detected"])):
+        if len(pers) <= periods.shape[1]:
+            periods[lo + i, :len(pers)] = pers
+            period_cnt[lo + i] = len(pers)
+        else:
+            extra.setdefault("periods", {})[lo + i] = pers
+        detected[lo + i] = det
+    for col in columns:
+        if col not in ("periods", "detected"):
+            extra[col] = dict(zip(range(lo, hi), resdf[col]))
+    periods.flush()
+    period_cnt.flush()
+    detected.flush()
+    return extra, counter, cache.drain() if cache is not None else None
+
+
+def run_shared(df, wrap, columns, maxproc=16, chunksize=None, max_periods=16, **kwargs):
+    """
+    run a wrap over df on the shared pool with the signals packed into one memory-mapped matrix
+
+    The equal-length signals are written once into an N x L buffer (in /dev/shm where available) and the workers
+    only receive row ranges. Periods, detected flags and period counts are written into shared output buffers,
+    only signals with more than max_periods periods and extra columns (e.g. 'stage') are sent back pickled.
+
+    Parameters:
+        df (DataFrame): frame with the "tdf" signal column, all signals dense and of equal length
+        wrap (function): single-process wrap, e.g. bcndetection_wrap
+        columns (list): result columns of the wrap, must include 'periods' and 'detected'
+        maxproc (int): number of worker processes
+        chunksize (int): signals per task, default_chunksize if None
+        max_periods (int): periods per signal that fit in the shared output buffer
+        **kwargs: passed to wrap, counter and cache are merged as in run_parallel
+    Returns:
+    DataFrame: df with the result columns filled in
+    """
+    n, length, dtype = signal_matrix_shape(df["tdf"])
+    chunksize = chunksize or default_chunksize(n, maxproc)
+    key_col = kwargs.get('key_col')
+    keys = list(df[key_col]) if key_col is not None else None
+
+    path = _shared_dir()
+    try:
+        signals = np.lib.format.open_memmap(os.path.join(path, "signals.npy"), mode="w+", dtype=dtype, shape=(n, length))
+        for i, sig in enumerate(df["tdf"]):
+            signals[i] = sig
+        signals.flush()
+        periods = np.lib.format.open_memmap(os.path.join(path, "periods.npy"), mode="w+", dtype=float, shape=(n, max_periods))
+        period_cnt = np.lib.format.open_memmap(os.path.join(path, "period_cnt.npy"), mode="w+", dtype=np.int32, shape=(n,))
+        detected = np.lib.format.open_memmap(os.path.join(path, "detected.npy"), mode="w+", dtype=bool, shape=(n,))
+
+        task_kwargs = _task_kwargs(kwargs)
+        tasks = ((wrap, columns, path, lo, min(lo + chunksize, n), key_col,
+                  keys[lo:lo + chunksize] if keys is not None else None, task_kwargs)
+                 for lo in range(0, n, chunksize))
+        extra = {}
+        for res, counter, cache_delta in get_pool(maxproc).imap(_run_shared_chunk, tasks):
+            for col, values in res.items():
+                extra.setdefault(col, {}).update(values)
+            _merge_task(kwargs, counter, cache_delta)
+
+        overflow = extra.pop("periods", {})
+        df["periods"] = [overflow[i] if i in overflow else list(periods[i, :period_cnt[i]]) for i in range(n)]
+        df["detected"] = np.array(detected)
+        for col in columns:
+            if col not in ("periods", "detected"):
+                df[col] = [extra[col][i] for i in range(n)]
+        del signals, periods, period_cnt, detected
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+    return df
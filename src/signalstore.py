@@ -0,0 +1,153 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+
+### signals per frame built by SignalStore.frames, bounds the float64 copies alive at a time
+STORE_CHUNKSIZE = 4096
+
+
+### narrowest unsigned integer dtype holding the matrix exactly, the matrix dtype if it has non-count values
+def narrow_dtype(matrix):
+    matrix = np.asarray(matrix)
+    if matrix.size == 0 or matrix.dtype.kind == 'u':
+        return matrix.dtype
+    if matrix.min() < 0 or not np.array_equal(matrix, np.round(matrix)):
+        return matrix.dtype
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if matrix.max() <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return matrix.dtype
+
+
+class SignalStore:
+    """
+    N x L matrix of equal-length signals with the remaining frame columns as metadata
+
+    Replaces the object "tdf" column of float64 arrays: minute counts are kept in the narrowest unsigned
+    integer dtype (uint8/uint16 for connection counts) and saved either as a .npy sidecar next to the
+    metadata parquet file, which load() memory-maps, or as a single parquet file with a FixedSizeList column.
+    All *_wrap and mltproc_*_wrap functions accept a SignalStore in place of the data frame.
+
+    Parameters:
+        signals (array): N x L signal matrix
+        meta (DataFrame): N rows of metadata (e.g. ts_cnt), optional
+        path (str): file the store was loaded from, if any
+    """
+
+    def __init__(self, signals, meta=None, path=None):
+        self.signals = signals
+        self.meta = meta if meta is not None else pd.DataFrame(index=range(len(signals)))
+        self.path = path
+
+    @classmethod
+    def from_frame(cls, df, dtype=None):
+        """
+        build a store from a frame with a "tdf" column of equal-length signals
+
+        Parameters:
+            df (DataFrame): signal frame, e.g. from gen_signal_df or read_parquet
+            dtype: signal dtype, narrow_dtype of the signals if None
+        """
+        signals = np.vstack(df["tdf"].values)
+        signals = signals.astype(dtype or narrow_dtype(signals))
+        meta = df.drop(columns="tdf").reset_index(drop=True)
+        return cls(signals, meta)
+
+    ### sidecar holding the signal matrix of a metadata parquet file
+    @staticmethod
+    def sidecar_path(path):
+        return os.path.splitext(path)[0] + ".signals.npy"
+
+    def save(self, path, fmt="npy"):
+        """
+        fmt='npy' writes the metadata to path and the signal matrix to the .signals.npy sidecar,
+        fmt='parquet' writes one parquet file with the signals as a FixedSizeList "tdf" column
+        """
+        if fmt == "npy":
+            np.save(self.sidecar_path(path), np.ascontiguousarray(self.signals))
+            self.meta.to_parquet(path, index=False)
+        elif fmt == "parquet":
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(self.meta, preserve_index=False)
+            values = pa.array(np.ascontiguousarray(self.signals).ravel())
+            table = table.append_column("tdf", pa.FixedSizeListArray.from_arrays(values, self.length))
+            pq.write_table(table, path)
+        else:
+            raise ValueError("unknown store format {}".format(fmt))
+        self.path = path
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        load a saved store, the .npy sidecar is memory-mapped read-only unless mmap=False,
+        a FixedSizeList parquet column is viewed without copying the decoded values
+        """
+        sidecar = cls.sidecar_path(path)
+        if os.path.exists(sidecar):
+            signals = np.load(sidecar, mmap_mode="r" if mmap else None)
+            return cls(signals, pd.read_parquet(path), path)
+
+        import pyarrow.parquet as pq
+        table = pq.read_table(path, memory_map=mmap)
+        column = table.column("tdf")
+        length = column.type.list_size
+        chunks = [chunk.flatten().to_numpy(zero_copy_only=True) for chunk in column.chunks]
+        values = chunks[0] if len(chunks) == 1 else np.concatenate(chunks)
+        meta = table.drop(["tdf"]).to_pandas()
+        return cls(values.reshape(-1, length), meta, path)
+
+    def __len__(self):
+        return self.signals.shape[0]
+
+    @property
+    def length(self):
+        return self.signals.shape[1]
+
+    @property
+    def nbytes(self):
+        return self.signals.nbytes
+
+    ### float64 copy of signal i
+    def row(self, i):
+        return self.signals[i].astype(float)
+
+    def frame(self, lo=0, hi=None):
+        """
+        Returns:
+        DataFrame: rows [lo, hi) with float64 "tdf" arrays and the metadata columns
+        """
+        hi = len(self) if hi is None else min(hi, len(self))
+        df = self.meta.iloc[lo:hi].copy()
+        df["tdf"] = list(self.signals[lo:hi].astype(float))
+        return df
+
+    def to_frame(self):
+        return self.frame()
+
+    ### frames of chunksize rows, only one chunk of float64 signals is materialized at a time
+    def frames(self, chunksize=STORE_CHUNKSIZE):
+        for lo in range(0, len(self), chunksize):
+            yield self.frame(lo, lo + chunksize)
+
+    def run(self, wrap, columns, chunksize=STORE_CHUNKSIZE):
+        """
+        run a wrap chunk by chunk over the store
+
+        Parameters:
+            wrap (function): wrap with all options bound, e.g. partial(bcndetection_wrap, seed=1)
+            columns (list): result columns of the wrap
+        Returns:
+        DataFrame: the metadata with the result columns
+        """
+        values = [[] for _ in columns]
+        for df in self.frames(chunksize):
+            resdf = wrap(df)
+            for j, col in enumerate(columns):
+                values[j].extend(resdf[col])
+        resdf = self.meta.copy()
+        for col, col_values in zip(columns, values):
+            resdf[col] = col_values
+        return resdf
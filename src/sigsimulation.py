@@ -2,10 +2,15 @@ import numpy as np
 import random
 import pandas as pd
 
-def omit(rate):
+from .helpfns import signal_rng
+
+### rng (np.random.Generator) replaces the global random / np.random states in the generators below
+def omit(rate, rng=None):
+    if rng is not None:
+        return rng.random() <= rate
     return random.random() <= rate
 
-def gen_periodic_signal_insec(period, std, omit_rate=0, length=1440 * 60):
+def gen_periodic_signal_insec(period, std, omit_rate=0, length=1440 * 60, rng=None):
     base = np.zeros(length)
     
     std_mult_period = std * period
@@ -17,13 +22,13 @@ def gen_periodic_signal_insec(period, std, omit_rate=0, length=1440 * 60):
             if std == 0:
                 shift = 0
             else:
-                shift = round(np.random.normal(0, std_mult_period))
+                shift = round((np.random if rng is None else rng).normal(0, std_mult_period))
             
             if (i + shift) < 0 or (i+shift) >= length:
                 continue
             else:
                 ## if the signal is not omitted, create signal
-                if not omit(omit_rate):
+                if not omit(omit_rate, rng):
                     base[i + shift] += 1
     return base
 
@@ -33,12 +38,14 @@ def resample_sig(sig, samplerate = 60):
     return np.array([sum(sig[i: i+samplerate]) for i in range(0, len(sig), samplerate)])
 
 
-def gen_signal_df(period, std=0, omit_rate=0, count=100, length=1440, samplerate=60):
+### seed makes every signal reproducible with its own rng derived from the seed and the signal parameters
+def gen_signal_df(period, std=0, omit_rate=0, count=100, length=1440, samplerate=60, seed=None):
     sigl = []
     
     for i in range(count):
+        rng = None if seed is None else signal_rng(seed, ("gauss", period, std, omit_rate, length, i))
         sig = np.zeros(length)
-        sig_1sec = gen_periodic_signal_insec(period=period, std=std, omit_rate=omit_rate, length=length*60)
+        sig_1sec = gen_periodic_signal_insec(period=period, std=std, omit_rate=omit_rate, length=length*60, rng=rng)
         sig += resample_sig(sig_1sec, samplerate)
         sigl.append(sig)
     
@@ -48,7 +55,7 @@ def gen_signal_df(period, std=0, omit_rate=0, count=100, length=1440, samplerate
     return sigdf
 
 
-def add_poisson_insert(period, std=0, prate=0., maxarrival=100, lam=5, length=1440 * 60):
+def add_poisson_insert(period, std=0, prate=0., maxarrival=100, lam=5, length=1440 * 60, rng=None):
     base = np.zeros(length)
         
     for i in range(length):
@@ -59,7 +66,10 @@ def add_poisson_insert(period, std=0, prate=0., maxarrival=100, lam=5, length=14
                 width = prate * period
                 _arrival_time = 0
                 for j in range(maxarrival):
-                    _inter_arrival_time = random.expovariate(lam)
+                    if rng is None:
+                        _inter_arrival_time = random.expovariate(lam)
+                    else:
+                        _inter_arrival_time = rng.exponential(1 / lam)
                     scaled_inter_arrival = round(width * _inter_arrival_time)
                     _arrival_time = _arrival_time + scaled_inter_arrival
                     if _arrival_time > width:
@@ -70,12 +80,13 @@ def add_poisson_insert(period, std=0, prate=0., maxarrival=100, lam=5, length=14
     return base
 
 
-def gen_poisson_signal_df(period, std=0, omit_rate=0, prate=0, count=100, maxarrival=100, lam=5, length=1440, samplerate=60):
+def gen_poisson_signal_df(period, std=0, omit_rate=0, prate=0, count=100, maxarrival=100, lam=5, length=1440, samplerate=60, seed=None):
     sigl = []
     
     for i in range(count):
+        rng = None if seed is None else signal_rng(seed, ("poisson", period, prate, maxarrival, lam, length, i))
         sig = np.zeros(length)
-        sig_1sec = add_poisson_insert(period=period, std=std, prate=prate, maxarrival=maxarrival, lam=lam, length=length*60)
+        sig_1sec = add_poisson_insert(period=period, std=std, prate=prate, maxarrival=maxarrival, lam=lam, length=length*60, rng=rng)
         sig += resample_sig(sig_1sec, samplerate)
         sigl.append(sig)
     
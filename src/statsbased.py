@@ -4,36 +4,75 @@ import multiprocessing
 
 ## import local functions
 from .helpfns import *
+from .runner import run_parallel, dispatch_wrap
 
 
-def stats_method(sig, threshold = 0.007):
+def stats_method(sig, threshold = 0.007, rng=None):
     """
     implementation of periodicity detection algorithm in ''A malware beacon of botnet by local periodic communication behavior''
     We use the original threshold = 0.007 in the paper
     Parameters:
-        sig (array): input time series
+        sig (array or SparseSignal): input time series
         threshold (float)
+        rng: accepted for a uniform detector interface, the method is deterministic
     Returns: 
     array: list of detected periods (empty if the method does not report specific detected periods)
     bool: True if the signal is periodic else False
     """
-    ts_intervals = get_ts_intervals(sig)
-    score = np.std(ts_intervals) / np.mean(ts_intervals)
+    score = stats_score(sig)
     return [], score < threshold
 
-def stats_wrap(df):
+### coefficient of variation of the time intervals
+def stats_score(sig):
+    ts_intervals = get_ts_intervals(sig)
+    return np.std(ts_intervals) / np.mean(ts_intervals)
+
+### stats_score of every row of a 2-D signal matrix from the flattened intervals of all rows
+### rows with fewer than 2 connections score nan like stats_score, a single interval scores 0
+def stats_score_batch(matrix):
+    matrix = np.atleast_2d(matrix)
+    intervals, rows = get_ts_intervals_batch(matrix)
+    sizes = np.bincount(rows, minlength=len(matrix))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = np.bincount(rows, intervals, len(matrix)) / sizes
+        variances = np.bincount(rows, (intervals - means[rows]) ** 2, len(matrix)) / sizes
+        return np.sqrt(variances) / means
+
+def stats_batch(matrix, threshold = 0.007, **kwargs):
+    """
+    matrix mode of stats_method over a batch of signals (any numeric dtype, e.g. a SignalStore chunk)
+    the coefficient of variation of the intervals of all rows is computed without a per-row loop
+    
+    Parameters:
+        matrix (2-D array): one signal per row
+        threshold (float)
+        kwargs: seed / key_col / keys are accepted for a uniform batch interface, the method is deterministic
+    Returns: 
+    list: empty period list for every row
+    array: bool array, True if the row is periodic else False
+    """
+    return [[] for _ in range(len(matrix))], stats_score_batch(matrix) < threshold
+
+def stats_wrap(df, batch=False, result_cache=None, dedup=False, **kwargs):
     """
     wrap func for multi process
+    batch=True scores the whole frame with stats_batch
     """    
-    df['periods'], df['detected'] = zip(*df["tdf"].apply(stats_method))
+    resdf = dispatch_wrap(df, stats_wrap, 'stats_method', ['periods', 'detected'], result_cache, dedup, batch=batch, **kwargs)
+    if resdf is not None:
+        return resdf
+    if batch:
+        df['periods'], df['detected'] = stats_batch(np.vstack(df["tdf"].values), **kwargs)
+        return df
+    df['periods'], df['detected'] = zip(*apply_method(df, stats_method, **kwargs))
     return df
 
-def mltproc_stats_wrap(df, maxproc = 16):
+def mltproc_stats_wrap(df, maxproc = 16, result_cache=None, dedup=False, chunksize=None, **kwargs):
     """
     wrap func for multiprocessing
     """    
-    pool = multiprocessing.Pool(processes = maxproc)    
-    df_lst = np.array_split(df, maxproc)
-    res = pool.map(stats_wrap, df_lst)
-    resdf = pd.concat(res)
-    return resdf
\ No newline at end of file
+    resdf = dispatch_wrap(df, mltproc_stats_wrap, 'stats_method', ['periods', 'detected'], result_cache, dedup,
+                          maxproc=maxproc, chunksize=chunksize, **kwargs)
+    if resdf is not None:
+        return resdf
+    return run_parallel(df, stats_wrap, ['periods', 'detected'], maxproc, chunksize, **kwargs)
\ No newline at end of file
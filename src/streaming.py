@@ -0,0 +1,133 @@
+import numpy as np
+
+from .bcndetection import bcndetection_method
+from .helpfns import signal_rng
+
+
+class _PairState:
+    """
+    ring buffer of the last `window` minutes of one pair and its DFT in the ring buffer frame
+    """
+    def __init__(self, window):
+        self.buf = np.zeros(window)
+        self.spec = np.zeros(window // 2 + 1, dtype=complex)
+        self.pos = 0
+        self.nnz = 0
+        self.updates = 0
+        self.peak = None
+        self.peak_power = 0.
+        self.result = ([], False)
+
+
+class StreamingBcnDetector:
+    """
+    near-real-time bcndetection over a sliding window of the last `window` minutes of every pair
+
+    The DFT of each ring buffer is updated in O(window) per changed minute with a sliding DFT. It is kept in the
+    ring buffer frame, Y_k = sum_i buf[i] exp(-2j pi k i / N), which only differs from the DFT of the chronological
+    window by a phase, so the periodogram is exact and a minute that stays at zero costs O(1).
+    The full bcndetection_method verification (EMD, permutation threshold, high frequency pruning, ACF peaks)
+    is only re-run when the spectral peak moves to another bin or its power changes by more than rel_change.
+
+    Parameters:
+        window (int): number of minutes in the sliding window
+        rel_change (float): relative change of the peak power that triggers a re-verification
+        resync_every (int): recompute the spectrum from the ring buffer after this many sliding updates (bounds rounding drift)
+        seed (int): run seed, every verification uses signal_rng(seed, window content)
+        **kwargs: passed to bcndetection_method
+    """
+    def __init__(self, window=1440, rel_change=0.2, resync_every=1440, seed=None, **kwargs):
+        self.window = window
+        self.seed = seed
+        self.rel_change = rel_change
+        self.resync_every = resync_every
+        self.method_kwargs = kwargs
+        self.states = {}
+        self.verify_cnt = 0
+        self._twiddle = np.exp(-2j * np.pi * np.arange(window) / window)
+        self._freq_idx = np.arange(window // 2 + 1)
+
+    def update(self, key, count):
+        """
+        push the count of the next minute of one pair
+
+        Returns:
+        array: list of detected periods of the current window
+        bool: True if the current window is periodic else False
+        """
+        state = self.states.get(key)
+        if state is None:
+            state = self.states[key] = _PairState(self.window)
+
+        old = state.buf[state.pos]
+        if count != old:
+            self._slide(state, old, count)
+            if state.nnz < 3:
+                self._reset(state)
+            elif self._peak_changed(state):
+                self._verify(state)
+        state.pos = (state.pos + 1) % self.window
+        return state.result
+
+    def tick(self, counts):
+        """
+        advance every pair by one minute, pairs missing from counts receive 0 and
+        pairs whose window becomes empty are dropped
+
+        Parameters:
+            counts (dict): pair key -> connection count of this minute
+        Returns:
+        dict: pair key -> (periods, detected) of the pairs whose result was recomputed in this minute
+        """
+        changed = {}
+        for key in list(self.states) + [key for key in counts if key not in self.states]:
+            before = self.states[key].result if key in self.states else None
+            result = self.update(key, counts.get(key, 0))
+            if result is not before:
+                changed[key] = result
+            if self.states[key].nnz == 0:
+                del self.states[key]
+        return changed
+
+    def result(self, key):
+        state = self.states.get(key)
+        return state.result if state is not None else ([], False)
+
+    ### chronological window of a pair, oldest minute first
+    def signal(self, key):
+        state = self.states[key]
+        return np.roll(state.buf, -state.pos)
+
+    def _slide(self, state, old, new):
+        state.buf[state.pos] = new
+        state.nnz += int(new > 0) - int(old > 0)
+        state.updates += 1
+        if state.updates % self.resync_every == 0:
+            state.spec = np.fft.rfft(state.buf)
+        else:
+            state.spec += (new - old) * self._twiddle[(self._freq_idx * state.pos) % self.window]
+
+    ### fewer than 3 connections in the window, same early exit as bcndetection_method
+    def _reset(self, state):
+        if state.peak is not None or state.result[1]:
+            state.peak = None
+            state.peak_power = 0.
+            state.result = ([], False)
+
+    def _peak_changed(self, state):
+        power = state.spec.real[1:] ** 2 + state.spec.imag[1:] ** 2
+        peak = int(np.argmax(power)) + 1
+        peak_power = power[peak - 1]
+        if peak == state.peak and abs(peak_power - state.peak_power) <= self.rel_change * state.peak_power:
+            return False
+        state.peak = peak
+        state.peak_power = peak_power
+        return True
+
+    def _verify(self, state):
+        self.verify_cnt += 1
+        sig = np.concatenate([state.buf[state.pos + 1:], state.buf[:state.pos + 1]])
+        if self.seed is not None:
+            state.result = bcndetection_method(sig, rng=signal_rng(self.seed, sig), **self.method_kwargs)
+        else:
+            state.result = bcndetection_method(sig, **self.method_kwargs)
@@ -4,39 +4,90 @@ import scipy
 from scipy import fft
 import multiprocessing
 
+from .helpfns import SpectralWorkspace, SparseSignal, as_workspace, apply_method
+from .runner import run_parallel, dispatch_wrap
 
-def upnsca_method(sig, threshold = 0.6059):
+
+def upnsca_method(sig, threshold = 0.6059, rng=None):
     """
     implementation of periodicity detection algorithm in ''Uncovering Periodic Network Signals of Cyber Attacks''
     We use the original threshold = 0.6059 in the paper
+    rng is accepted for a uniform detector interface, the method is deterministic
     
     Returns: 
     array: list of detected periods (empty if the method does not report specific detected periods)
     bool: True if the signal is periodic else False
     """
+    return [], upnsca_score(sig) > threshold
+
+
+### ratio of the energy in the top 10% rfft magnitudes to the total energy
+def upnsca_score(sig):
     # since the input signal is always a real number list in our network environment setup
     # we use rfft(https://docs.scipy.org/doc/scipy/reference/generated/scipy.fft.rfft.html) to speed up the computation
-    fftSpec = scipy.fft.rfft(sig)
-    energyDist = sorted(abs(fftSpec), reverse=True)
-    domFreqs = int(len(sig) / 10)
+    # a SpectralWorkspace input reuses the rfft shared with the other detectors,
+    # a SparseSignal input computes it as a direct sum over its events
+    if isinstance(sig, (SpectralWorkspace, SparseSignal)):
+        ws = as_workspace(sig)
+        fftAbs = ws.rfft_abs
+        siglen = ws.n
+    else:
+        fftAbs = abs(scipy.fft.rfft(sig))
+        siglen = len(sig)
+    energyDist = sorted(fftAbs, reverse=True)
+    domFreqs = int(siglen / 10)
     per = sum(energyDist[:domFreqs]) / sum(energyDist)  
-    return [], per > threshold
+    return per
+
+
+### upnsca_score of every row of a 2-D signal matrix with one 2-D rfft,
+### the top 10% magnitudes are selected with np.partition instead of a full sort
+### signals shorter than 10 samples have no dominant frequency and score 0, as upnsca_score
+def upnsca_score_batch(matrix):
+    matrix = np.atleast_2d(np.asarray(matrix, dtype=float))
+    domFreqs = int(matrix.shape[1] / 10)
+    if domFreqs == 0:
+        return np.zeros(len(matrix))
+    fftAbs = np.abs(fft.rfft(matrix, axis=1))
+    domFreqs = min(domFreqs, fftAbs.shape[1])
+    top = np.partition(fftAbs, fftAbs.shape[1] - domFreqs, axis=1)[:, fftAbs.shape[1] - domFreqs:]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return top.sum(axis=1) / fftAbs.sum(axis=1)
+
+
+def upnsca_batch(matrix, threshold = 0.6059, **kwargs):
+    """
+    matrix mode of upnsca_method over a batch of equal-length signals (any numeric dtype, e.g. a SignalStore chunk)
+    seed / key_col / keys are accepted for a uniform batch interface, the method is deterministic
+    
+    Returns: 
+    list: empty period list for every row
+    array: bool array, True if the row is periodic else False
+    """
+    return [[] for _ in range(len(matrix))], upnsca_score_batch(matrix) > threshold
 
 
-def upnsca_wrap(df):
+def upnsca_wrap(df, batch=False, result_cache=None, dedup=False, **kwargs):
     """
     wrap for data frame processing
+    batch=True scores the whole frame with upnsca_batch (equal-length signals)
     """    
-    df['periods'], df['detected'] = zip(*df["tdf"].apply(upnsca_method))
+    resdf = dispatch_wrap(df, upnsca_wrap, 'upnsca_method', ['periods', 'detected'], result_cache, dedup, batch=batch, **kwargs)
+    if resdf is not None:
+        return resdf
+    if batch:
+        df['periods'], df['detected'] = upnsca_batch(np.vstack(df["tdf"].values), **kwargs)
+        return df
+    df['periods'], df['detected'] = zip(*apply_method(df, upnsca_method, **kwargs))
     return df
 
 
-def mltproc_upnsca_wrap(df, maxproc = 16):
+def mltproc_upnsca_wrap(df, maxproc = 16, result_cache=None, dedup=False, chunksize=None, **kwargs):
     """
     wrap func for multiprocessing
     """    
-    pool = multiprocessing.Pool(processes = maxproc)    
-    df_lst = np.array_split(df, maxproc)
-    res = pool.map(upnsca_wrap, df_lst)
-    resdf = pd.concat(res)
-    return resdf
\ No newline at end of file
+    resdf = dispatch_wrap(df, mltproc_upnsca_wrap, 'upnsca_method', ['periods', 'detected'], result_cache, dedup,
+                          maxproc=maxproc, chunksize=chunksize, **kwargs)
+    if resdf is not None:
+        return resdf
+    return run_parallel(df, upnsca_wrap, ['periods', 'detected'], maxproc, chunksize, **kwargs)
\ No newline at end of file